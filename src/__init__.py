@@ -45,7 +45,7 @@ from item import Item
 from file import File
 from media import Media
 from kaa.db import *
-from query import register_filter, wrap, Query
+from query import register_filter, wrap, Query, SearchSession
 
 import plugins
 
@@ -152,6 +152,15 @@ def query(**args):
     """
     return _client.query(**args)
 
+@require_connect()
+def search(**args):
+    """
+    Create a session for live keyword searches while the user is typing.
+    The function returns an InProgress object with a SearchSession object
+    as result. Call update() on the session for every keystroke.
+    """
+    return _client.search(**args)
+
 @require_connect()
 def get(filename):
     """
@@ -192,9 +201,11 @@ def list_media(available=True):
 @require_connect()
 def delete_media(id):
     """
-    Delete media with the given id.
+    Delete media with the given id. The progress is reported with the
+    media.delete signal.
 
     :param id: Media object ID
+    :returns: an InProgress object finished when the media is deleted
     """
     return _client.delete_media(id)
 
@@ -248,6 +259,18 @@ def get_db_info():
     """
     return _client.get_db_info()
 
+@require_connect()
+def get_growing_files():
+    """
+    Get the files still written, e.g. recordings or downloads. Beacon
+    does not parse these files again before their size is stable.
+
+    :returns: InProgress with a dict mapping the filename to a dict with
+              the current size, the growth rate in bytes per second and
+              the time the file was first seen growing
+    """
+    return _client.get_growing_files()
+
 @require_connect()
 def rpc(command, *args, **kwargs):
     """
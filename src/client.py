@@ -42,7 +42,7 @@ import kaa.rpc
 
 # kaa.beacon imports
 from db import Database
-from query import Query
+from query import Query, SearchSession
 from item import Item
 from media import Media
 import thumbnail
@@ -65,7 +65,8 @@ class Client(object):
             'connect'   : kaa.Signal(),
             'disconnect': kaa.Signal(),
             'media.add' : kaa.Signal(),
-            'media.remove': kaa.Signal()
+            'media.remove': kaa.Signal(),
+            'media.delete': kaa.Signal()
         }
         # internal list of active queries, mapping query id to a Query object weakref.
         self._queries = weakref.WeakValueDictionary()
@@ -106,6 +107,14 @@ class Client(object):
         yield kaa.inprogress(query)
         yield query
 
+    def search(self, latency=0.1, **kwargs):
+        """
+        Create a SearchSession for live keyword searches while the user
+        is typing. Additional keyword arguments restrict the search, e.g.
+        type='audio'.
+        """
+        return SearchSession(self, latency, **kwargs)
+
     def add_item(self, url, type, parent, **kwargs):
         """
         Add non-file item item.
@@ -168,9 +177,19 @@ class Client(object):
 
     def delete_media(self, id):
         """
-        Delete media with the given id.
+        Delete media with the given id. The media.delete signal is
+        emitted with the media id, the number of deleted objects and the
+        total number while the server is deleting.
         """
-        self.rpc('delete_media', id)
+        return self.rpc('delete_media', id)
+
+    def get_growing_files(self):
+        """
+        Return a dict of all files the server sees growing, mapping the
+        filename to a dict with size, rate (bytes per second) and the
+        time the growth started.
+        """
+        return self.rpc('growing_files')
 
     def get_db_info(self):
         """
@@ -352,3 +371,11 @@ class Client(object):
         media = self._db.medialist.remove(id)
         if media:
             self.signals['media.remove'].emit(media)
+
+    @kaa.rpc.expose('device.delete_progress')
+    def media_delete_progress(self, id, deleted, total):
+        """
+        Notification about the progress of deleting the media with the
+        given id.
+        """
+        self.signals['media.delete'].emit(id, deleted, total)
@@ -32,6 +32,8 @@ import stat
 import logging
 import time
 import hashlib
+import re
+import heapq
 
 # kaa imports
 import kaa
@@ -44,6 +46,61 @@ from media import MediaList, FakeMedia
 # get logging object
 log = logging.getLogger('beacon.db')
 
+# Maximum number of ids in one 'IN' query. SQLite has a limit of 999
+# variables in one statement.
+MAX_IN_QUERY = 500
+
+# Split keywords into terms, a term may end with '*' for a prefix search
+_find_terms = re.compile(r'[^\W_]+\*?', re.U).findall
+
+# Weight of a matching term in the given attribute for ranked keyword
+# queries. The name is split into path components.
+RANK_WEIGHTS = { 'title': 3.0, 'artist': 2.0, 'album': 2.0, 'name': 1.0 }
+
+def _facet_key(value):
+    """
+    Return a hashable key for a query value. Helper for the cache of
+    attribute queries.
+    """
+    if isinstance(value, db.QExpr):
+        return value._operator, repr(value._operand)
+    return repr(value)
+
+def _path_range(path):
+    """
+    Return the query expression for all objects below path. kaa.db
+    stores str attributes as BLOB and does not convert the bounds of a
+    range, they have to be buffers.
+    """
+    return db.QExpr('range', (buffer(path), buffer(path + '\xff')))
+
+def _rank(row, terms):
+    """
+    Return the relevance score of the database row for the list of
+    keyword terms. Every term matching a word of an attribute scores
+    the weight of the attribute divided by the number of words.
+    """
+    score = 0.0
+    for attr, weight in RANK_WEIGHTS.items():
+        value = row.get(attr)
+        if not value:
+            continue
+        if attr == 'name':
+            words = db.split_path(value)
+        else:
+            words = _find_terms(value)
+        words = [ kaa.str_to_unicode(w).lower() for w in words ]
+        if not words:
+            continue
+        matches = 0
+        for term in terms:
+            if term.endswith('*'):
+                matches += len([ w for w in words if w.startswith(term[:-1]) ])
+            else:
+                matches += words.count(term)
+        score += weight * matches / len(words)
+    return score
+
 # Item generation mapping
 from file import File
 from item import Item
@@ -52,7 +109,6 @@ def create_item(data, parent):
     """
     Create an Item that is neither dir nor file.
     """
-    data = dict(data)
     dbid = (data['type'], data['id'])
     if 'url' in data:
         # url is stored in the data
@@ -136,6 +192,19 @@ class Database(kaa.Object):
         self.medialist = MediaList()
         # create or open db
         self._db = db.Database(self.directory + '/db')
+        # Cache of database rows of parent objects shared between all
+        # queries. Only the server knows when the database changes, so
+        # the cache is only enabled there.
+        self._parent_cache = None
+        # Cache of attribute queries with count or sum, grouped by type.
+        # Also only enabled in the server, clients query their read-only
+        # database without a cache.
+        self._facet_cache = None
+        # Parent objects shared by all query results as long as one of
+        # them is alive, mapping (type, id) to the object. A client can
+        # not know when a parent is renamed or moved, so this is also
+        # only enabled in the server.
+        self._objects = None
 
     def commit():
         """
@@ -193,12 +262,19 @@ class Database(kaa.Object):
         Main query function. This function will call one of the specific
         query functions in this class depending on the query. This function
         returns an InProgress.
+
+        Queries returning items support the special keywords limit, offset
+        and order_by to request only a part of the result. order_by is the
+        name of an attribute, prefixed with '-' for descending order. A
+        keyword query with rank=True returns the most relevant items first.
         """
         # Remove non-true recursive attribute from query (non-recursive is default).
         if not query.get('recursive', True):
             del query['recursive']
         # Passed by caller to collect list of deleted items for directory query.
         garbage = query.pop('garbage', None)
+        # Recursive directory queries check the filesystem by default.
+        verify = query.pop('verify', True)
         # do query based on type
         if query.keys() == ['filename']:
             fname = os.path.realpath(query['filename'])
@@ -208,6 +284,8 @@ class Database(kaa.Object):
         if sorted(query.keys()) == ['parent', 'recursive']:
             if not query['parent']._beacon_isdir:
                 raise AttributeError('parent is no directory')
+            if not verify:
+                return self._db_query_subtree(query['parent'])
             return self._db_query_dir_recursive(query['parent'], garbage)
         if 'parent' in query:
             if len(query) == 1:
@@ -354,11 +432,13 @@ class Database(kaa.Object):
         # A list of all directories we will look at. If a link is in the
         # directory it will be ignored.
         directories = [ parent ]
-        while directories:
-            parent = directories.pop(0)
+        pos = 0
+        while pos < len(directories):
+            parent = directories[pos]
+            pos += 1
             for i in (yield self._db_query_dir(parent, garbage)):
                 if i.isdir and not i._beacon_islink:
-                    directories.append(child)
+                    directories.append(i)
                 items.append(i)
             if time.time() > timer + 0.1:
                 # we used too much time. Call yield NotFinished at
@@ -370,47 +450,309 @@ class Database(kaa.Object):
         items.sort(lambda x,y: cmp(x._beacon_name, y._beacon_name))
         yield items
 
+    @kaa.coroutine()
+    def _db_query_subtree(self, parent):
+        """
+        Return all files in the directory 'parent' including files in
+        subdirectories like _db_query_dir_recursive but based on the
+        database only. The filesystem is not checked, so new files not
+        scanned by the server are missing. The subtree is fetched with one
+        query using the path attribute.
+        """
+        if parent._beacon_islink:
+            # WARNING: parent is a link, we need to follow it
+            parent = self.query_filename(os.path.realpath(parent.filename))
+            if not parent._beacon_isdir:
+                # oops, this is not directory anymore, return nothing
+                yield []
+        if not parent._beacon_id:
+            # not in the database
+            yield []
+        # All objects below the directory are found by the path prefix.
+        # Sort them by path, a parent is always before its children.
+        path = self._db_path(parent._beacon_id)
+        rows = self._db.query(path=_path_range(path))
+        rows.sort(key=lambda r: len(r['path']))
+        yield kaa.NotFinished
+        timer = time.time()
+        items = []
+        # The directories found. If a link is in the directory it will
+        # be ignored.
+        directories = { parent._beacon_id: parent }
+        for r in rows:
+            if r['parent'] not in directories:
+                # child of a softlink
+                continue
+            if r['type'] == 'dir':
+                i = create_directory(r, directories[r['parent']])
+                if not i._beacon_islink:
+                    directories[i._beacon_id] = i
+            else:
+                i = create_by_type(r, directories[r['parent']])
+            items.append(i)
+            if time.time() > timer + 0.1:
+                # we used too much time. Call yield NotFinished at
+                # this point to continue later.
+                timer = time.time()
+                yield kaa.NotFinished
+        items.sort(lambda x,y: cmp(x._beacon_name, y._beacon_name))
+        yield items
+
+    def _db_path(self, entry):
+        """
+        Return the path of all objects below entry, a (type, id) tuple.
+        Every object stores the path of its parent, a list of type:id of
+        all ancestors starting with the media, e.g.
+        'media:1/dir:1/dir:5/'. Returns None if entry is not in the
+        database.
+        """
+        type, id = entry
+        if type == 'media':
+            return 'media:%d/' % id
+        row = None
+        if self._parent_cache is not None:
+            row = self._parent_cache.get(entry)
+        if row is None:
+            rows = self._db.query(type=type, id=id)
+            if not rows:
+                return None
+            row = rows[0]
+            if self._parent_cache is not None:
+                self._parent_cache[entry] = row
+        return '%s%s:%d/' % (row.get('path') or '', type, id)
+
     def _db_query_id(self, (type, id), cache=None):
         """
         Return item based on (type,id). Use given cache if provided.
         """
         i = self._db.query(type=type, id=id)[0]
-        # now we need a parent
         if i['name'] == '':
             # root node found, find correct mountpoint
-            m = self.medialist.get_by_beacon_id(i['parent'])
-            if not m:
-                # media not mounted, make it an Item, not a File
-                result = self._db.query(type="media", id=i['parent'][1])
-                if not result:
-                    raise AttributeError('bad media %s' % str(i['parent']))
-                return create_item(i, FakeMedia(result[0]['name']))
-            return create_directory(i, m)
-        # query for parent
+            return self._db_create_root(i)
+        if cache is None:
+            cache = {}
         pid = i['parent']
-        if cache is not None and pid in cache:
-            parent = cache[pid]
-        else:
-            parent = self._db_query_id(pid)
-            if cache is not None:
-                cache[pid] = parent
+        self._db_query_parents([pid], cache)
         if i['type'] == 'dir':
             # it is a directory, make a dir item
-            return create_directory(i, parent)
-        return create_by_type(i, parent)
+            return create_directory(i, cache[pid])
+        return create_by_type(i, cache[pid])
+
+    def _db_create_root(self, row):
+        """
+        Create the root item of a media based on the database row.
+        """
+        m = self.medialist.get_by_beacon_id(row['parent'])
+        if not m:
+            # media not mounted, make it an Item, not a File
+            result = self._db.query(type="media", id=row['parent'][1])
+            if not result:
+                raise AttributeError('bad media %s' % str(row['parent']))
+            return create_item(row, FakeMedia(result[0]['name']))
+        return create_directory(row, m)
+
+    def _db_query_parents(self, pids, cache):
+        """
+        Create the parent objects for the given list of (type, id) and
+        store them in cache. Ancestors neither in cache nor in the parent
+        cache are fetched level by level with one query per object type.
+        """
+        rows = {}
+        missing = set([ pid for pid in pids if not self._db_lookup_object(pid, cache) ])
+        while missing:
+            by_type = {}
+            for pid in missing:
+                if self._parent_cache is not None and pid in self._parent_cache:
+                    rows[pid] = self._parent_cache[pid]
+                else:
+                    by_type.setdefault(pid[0], []).append(pid[1])
+            for type, ids in by_type.items():
+                for pos in range(0, len(ids), MAX_IN_QUERY):
+                    for r in self._db.query(type=type, id=db.QExpr('in', ids[pos:pos+MAX_IN_QUERY])):
+                        rows[(r['type'], r['id'])] = r
+                        if self._parent_cache is not None:
+                            self._parent_cache[(r['type'], r['id'])] = r
+            # next level: the parents of all rows we got that are not
+            # root nodes (their parent is the media)
+            parents = [ rows[pid]['parent'] for pid in missing if pid in rows and rows[pid]['name'] ]
+            missing = set([ pid for pid in parents if pid not in rows and \
+                            not self._db_lookup_object(pid, cache) ])
+        for pid in pids:
+            self._db_create_parent(pid, rows, cache)
+
+    def _db_lookup_object(self, pid, cache):
+        """
+        Return True if the object pid is in the cache or is a shared parent
+        object still alive. In the latter case it is added to the cache.
+        """
+        if pid in cache:
+            return True
+        if self._objects is None:
+            return False
+        obj = self._objects.get(pid)
+        if obj is None:
+            return False
+        cache[pid] = obj
+        return True
+
+    def _db_invalidate_objects(self, changes=None):
+        """
+        Forget the shared parent objects if one of the given list of
+        (type, id) is a shared object or if changes is None. The children
+        of a changed object reference it as parent, so all objects are
+        removed.
+        """
+        if self._objects is None:
+            return
+        if changes is None:
+            self._objects.clear()
+            return
+        for entry in changes:
+            if entry in self._objects:
+                self._objects.clear()
+                return
+
+    def _db_create_parent(self, pid, rows, cache):
+        """
+        Create the parent object pid from the given rows. Helper function
+        for _db_query_parents.
+        """
+        if self._db_lookup_object(pid, cache):
+            return cache[pid]
+        r = rows[pid]
+        if r['name'] == '':
+            parent = self._db_create_root(r)
+        elif r['type'] == 'dir':
+            parent = create_directory(r, self._db_create_parent(r['parent'], rows, cache))
+        else:
+            parent = create_by_type(r, self._db_create_parent(r['parent'], rows, cache))
+        if self._objects is not None:
+            self._objects[pid] = parent
+        cache[pid] = parent
+        return parent
 
     def _db_query_attr(self, query):
         """
         A query to get a list of possible values of one attribute. Special
         keyword 'attr' the query is used for that. This query will not return
         a list of items.
-        """
-        attr = query['attr']
-        del query['attr']
-        result = self._db.query(attrs=[attr], distinct=True, **query)
-        result = [ x[attr] for x in result if x[attr] ]
-        # sort results and return
+
+        If attr is a list of attributes or the special keyword count or sum
+        is given, the result is a list of tuples with the values of the
+        attributes, followed by the number of objects (count=True) and the
+        sum of the given attribute (e.g. sum='length') for each value.
+        """
+        attr = query.pop('attr')
+        count = query.pop('count', False)
+        total = query.pop('sum', None)
+        if isinstance(attr, basestring) and not count and not total:
+            result = self._db.query(attrs=[attr], distinct=True, **query)
+            result = [ x[attr] for x in result if x[attr] ]
+            # sort results and return
+            result.sort()
+            return result
+        if isinstance(attr, basestring):
+            attr = [ attr ]
+        attr = list(attr)
+        if self._facet_cache is not None:
+            key = tuple(sorted([ (k, _facet_key(v)) for k, v in query.items() ]))
+            key = key, tuple(attr), count, total
+            cache = self._facet_cache.setdefault(query.get('type'), {})
+            if key in cache:
+                return cache[key]
+        result = self._db_query_facets_sql(attr, count, total, query)
+        if result is None:
+            # The database can not group by the attributes, do it in
+            # one pass over all objects. Attributes ignoring the case
+            # are grouped case insensitive like in the database.
+            groups = {}
+            fold = {}
+            for r in self._db.query(**query):
+                values = tuple([ r.get(a) for a in attr ])
+                if None in values or '' in values:
+                    continue
+                if r['type'] not in fold:
+                    attrs = self._db._object_types[r['type']][1]
+                    fold[r['type']] = [ a in attrs and attrs[a][1] & db.ATTR_IGNORE_CASE for a in attr ]
+                fkey = tuple([ f and v.lower() or v for f, v in zip(fold[r['type']], values) ])
+                group = groups.get(fkey)
+                if group is None:
+                    group = groups[fkey] = [ values, 0, 0 ]
+                group[1] += 1
+                if total:
+                    group[2] += r.get(total) or 0
+            result = []
+            for values, num, value in groups.values():
+                if count:
+                    values += (num,)
+                if total:
+                    values += (value,)
+                result.append(values)
         result.sort()
+        if self._facet_cache is not None:
+            cache[key] = result
+        return result
+
+    def _db_query_facets_sql(self, attr, count, total, query):
+        """
+        Group the objects by the attributes with SQL. This only works
+        for one type with searchable attributes, and the query has to be
+        simple. The values are taken from one object of each group to get
+        them the way kaa.db returns them, e.g. the original case for
+        attributes ignoring the case. Returns None if not possible.
+        """
+        if query.get('type') not in self._db._object_types:
+            return None
+        attrs = self._db._object_types[query['type']][1]
+        for a in attr + (total and [ total ] or []):
+            if a not in attrs or not attrs[a][1] & db.ATTR_SEARCHABLE:
+                return None
+        where, args = [], []
+        for key, value in query.items():
+            if key == 'type':
+                continue
+            if key not in attrs or not attrs[key][1] & db.ATTR_SEARCHABLE or \
+                   attrs[key][1] & db.ATTR_IGNORE_CASE:
+                return None
+            if isinstance(value, db.QExpr):
+                if value._operator != 'in' or not value._operand:
+                    return None
+                values = list(value._operand)
+                where.append('%s IN (%s)' % (key, ','.join(['?'] * len(values))))
+            else:
+                values = [ value ]
+                where.append('%s=?' % key)
+            if attrs[key][0] == str:
+                # str attributes are stored as BLOB
+                values = [ buffer(v) for v in values ]
+            args.extend(values)
+        for a in attr:
+            where.append('%s IS NOT NULL' % a)
+        select = [ 'MIN(id)', 'COUNT(*)' ]
+        if total:
+            select.append('SUM(%s)' % total)
+        sql = 'SELECT %s FROM objects_%s WHERE %s GROUP BY %s' % \
+              (','.join(select), query['type'], ' AND '.join(where), ','.join(attr))
+        groups = self._db._db_query(sql, args)
+        # get the attribute values from the first object of each group
+        ids = [ g[0] for g in groups ]
+        rows = {}
+        for pos in range(0, len(ids), MAX_IN_QUERY):
+            for r in self._db.query(type=query['type'], id=db.QExpr('in', ids[pos:pos+MAX_IN_QUERY]),
+                                    attrs=['id'] + attr):
+                rows[r['id']] = r
+        result = []
+        for group in groups:
+            if group[0] not in rows:
+                continue
+            values = tuple([ rows[group[0]].get(a) for a in attr ])
+            if None in values or '' in values:
+                continue
+            if count:
+                values += (group[1],)
+            if total:
+                values += (group[2] or 0,)
+            result.append(values)
         return result
 
     @kaa.coroutine()
@@ -423,6 +765,39 @@ class Database(kaa.Object):
         """
         # FIXME: this function needs optimizing; adds at least 6 times the
         # overhead on top of kaa.db.query
+        limit = query.pop('limit', None)
+        offset = query.pop('offset', 0)
+        order_by = query.pop('order_by', None)
+        rank = query.pop('rank', False) and not order_by and query.get('keywords')
+        if limit is not None and not order_by and not rank:
+            # No special order requested, let the database stop after the
+            # rows we need. kaa.db has no offset, the first rows are
+            # skipped below.
+            query['limit'] = offset + limit
+        if '*' in query.get('keywords', ''):
+            rows = self._db_query_prefix(query)
+        else:
+            rows = self._db.query(**query)
+        if rank:
+            # Score the database rows, the items are only created for the
+            # requested page.
+            terms = _find_terms(kaa.str_to_unicode(query['keywords']).lower())
+            key = lambda r: _rank(r, terms)
+            if limit is None:
+                rows.sort(key=key, reverse=True)
+            else:
+                rows = heapq.nlargest(offset + limit, rows, key=key)
+        elif order_by:
+            # Sort the database rows and not the items. This avoids
+            # creating items (and their parents) not part of the result.
+            reverse = order_by.startswith('-')
+            order_by = order_by.lstrip('-')
+            rows.sort(key=lambda r: (r.get(order_by), r['id']), reverse=reverse)
+        if offset or limit is not None:
+            if limit is None:
+                rows = rows[offset:]
+            else:
+                rows = rows[offset:offset+limit]
         result = []
         cache = {}
         counter = 0
@@ -430,14 +805,10 @@ class Database(kaa.Object):
         for media in self.medialist:
             cache[media._beacon_id] = media
             cache[media.root._beacon_id] = media.root
-        for r in self._db.query(**query):
-            # get parent
-            pid = r['parent']
-            if pid in cache:
-                parent = cache[pid]
-            else:
-                parent = self._db_query_id(pid, cache)
-                cache[pid] = parent
+        # resolve all parents at once
+        self._db_query_parents(set([ r['parent'] for r in rows ]), cache)
+        for r in rows:
+            parent = cache[r['parent']]
             # create item
             if r['type'] == 'dir':
                 # it is a directory, make a dir item
@@ -451,11 +822,81 @@ class Database(kaa.Object):
                 # this point to continue later.
                 timer = time.time()
                 yield kaa.NotFinished
-        if not 'keywords' in query:
+        if not 'keywords' in query and not order_by and limit is None and not offset:
             # sort results by url (name is not unique) and return
             result.sort(lambda x,y: cmp(x.url, y.url))
         yield result
 
+    def _db_query_prefix(self, query):
+        """
+        Query for keywords with prefix terms like 'beat*'. kaa.db only
+        matches whole terms. The terms table of the inverted index has a
+        unique index on the term, so a prefix is expanded with a range
+        scan on that table. All terms must match. Terms the index does
+        not store (too short or long, ignored words) are dropped like
+        kaa.db does. Returns the database rows in no special order.
+        """
+        query = query.copy()
+        keywords = kaa.str_to_unicode(query.pop('keywords')).lower()
+        limit = query.pop('limit', None)
+        wanted = query.pop('type', None)
+        objects = None
+        for term in self._db_index_terms('keywords', _find_terms(keywords)):
+            if term.endswith('*'):
+                where, args = 'term >= ? AND term < ?', (term[:-1], term[:-1] + u'\uffff')
+            else:
+                where, args = 'term = ?', (term,)
+            found = set(self._db._db_query(
+                'SELECT object_type, object_id FROM ivtidx_keywords_terms_map '
+                'WHERE term_id IN (SELECT id FROM ivtidx_keywords_terms WHERE %s)' % where, args))
+            if objects is None:
+                objects = found
+            else:
+                objects &= found
+            if not objects:
+                return []
+        # group object ids by type and get the rows
+        types = {}
+        for name, (type_id, attrs, indexes) in self._db._object_types.items():
+            types[type_id] = name
+        ids = {}
+        for type_id, id in objects or []:
+            ids.setdefault(types.get(type_id), []).append(id)
+        rows = []
+        for type, type_ids in ids.items():
+            if not type or (wanted and wanted != type):
+                continue
+            for pos in range(0, len(type_ids), MAX_IN_QUERY):
+                query['type'] = type
+                query['id'] = db.QExpr('in', type_ids[pos:pos+MAX_IN_QUERY])
+                rows.extend(self._db.query(**query))
+                if limit is not None and len(rows) >= limit:
+                    return rows[:limit]
+        return rows
+
+    def _db_index_terms(self, name, terms):
+        """
+        Return the terms of the list in the inverted index name. A prefix
+        term may be shorter than the minimum or an ignored word because
+        longer terms start with it.
+        """
+        ivtidx = getattr(self._db, '_inverted_indexes', {}).get(name, {})
+        min, max = ivtidx.get('min') or 0, ivtidx.get('max') or 0
+        ignore = ivtidx.get('ignore') or ()
+        result = []
+        for term in terms:
+            word = term.rstrip('*')
+            if max and len(word) > max:
+                continue
+            if term.endswith('*'):
+                if word:
+                    result.append(term)
+                continue
+            if len(word) < min or word in ignore:
+                continue
+            result.append(term)
+        return result
+
     def query_filename(self, filename):
         """
         Return item for filename, This function will
@@ -48,6 +48,8 @@ class File(Item):
     """
     A file-based database item
     """
+    __slots__ = ('_beacon_islink', '_beacon_listdir_cache')
+
     def __init__(self, id, filename, data, parent, media, isdir=False):
         Item.__init__(self, id, 'file://' + filename, data, parent, media)
         if self._beacon_data.get('scheme'):
@@ -61,15 +63,21 @@ class File(Item):
             if os.path.islink(filename[:-1]):
                 self._beacon_islink = True
 
-    def list(self, recursive=False):
+    def list(self, recursive=False, verify=True):
         """
         Return a Query object for a query with all files in the
         directory. If the Item is no directory all subitems will
         returned similar to the Item list function. This can happen
         for DVD iso files on hard-disc. If the client is not connected
         to the server an empty list will be returned instead.
+
+        A recursive query checks every directory on the filesystem. If
+        verify is False, only the database is used which is much faster
+        for large trees but does not include files not scanned yet.
         """
         # Note: this function is not used internally
+        if recursive and not verify:
+            return self._beacon_controller.query(parent=self, recursive=True, verify=False)
         return self._beacon_controller.query(parent=self, recursive=recursive)
 
     def _beacon_listdir(self, cache=False):
@@ -117,6 +125,24 @@ class File(Item):
         self._beacon_listdir_cache = time.time(), result, results_file_map
         return result, results_file_map
 
+    @property
+    def _beacon_stat(self):
+        """
+        Return the stat result of the file from the directory listing
+        of the parent or None. This function is only used by the server
+        part of beacon.
+        """
+        if self._beacon_isdir:
+            try:
+                return os.stat(self.filename)
+            except (OSError, IOError):
+                return None
+        listdir_file_map = self._beacon_parent._beacon_listdir(cache=True)[1]
+        entry = listdir_file_map.get(self._beacon_data['name'])
+        if entry:
+            return entry[2]
+        return None
+
     @property
     def _beacon_mtime(self):
         """
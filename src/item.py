@@ -40,24 +40,99 @@ from utils import get_title
 # get logging object
 log = logging.getLogger('beacon')
 
+# marker for ItemData lookups
+_MISSING = object()
+
+class ItemData(object):
+    """
+    Attributes of an item. The database row (a kaa.db ObjectRow sharing the
+    column description with all rows of the query) is not copied, changed
+    attributes are stored in a dict on top of it that is only created on the
+    first change.
+    """
+    __slots__ = ('_row', '_dict')
+
+    def __init__(self, row):
+        if isinstance(row, ItemData):
+            self._row = row._row
+            self._dict = row._dict and dict(row._dict)
+        else:
+            self._row = row
+            self._dict = None
+
+    def get(self, key, default=None):
+        if self._dict and key in self._dict:
+            return self._dict[key]
+        return self._row.get(key, default)
+
+    def __getitem__(self, key):
+        if self._dict and key in self._dict:
+            return self._dict[key]
+        return self._row[key]
+
+    def __setitem__(self, key, value):
+        if self._dict is None:
+            self._dict = {}
+        self._dict[key] = value
+
+    def __contains__(self, key):
+        return (self._dict and key in self._dict) or \
+               self._row.get(key, _MISSING) is not _MISSING
+
+    has_key = __contains__
+
+    def update(self, data):
+        if self._dict is None:
+            self._dict = {}
+        self._dict.update(data)
+
+    def keys(self):
+        keys = list(self._row.keys())
+        if self._dict:
+            keys.extend([ key for key in self._dict if key not in keys ])
+        return keys
+
+    def items(self):
+        return [ (key, self[key]) for key in self.keys() ]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 class Item(object):
     """
     A generic database item
     """
+    # Items are created for every query result. Avoid the instance dict
+    # and create tmpdata and changes only when needed.
+    __slots__ = ('url', 'filename', '_beacon_id', '_beacon_data', '_beacon_tmpdata',
+                 '_beacon_parent', '_beacon_media', '_beacon_isdir', '_beacon_changes',
+                 '_beacon_name', '__weakref__')
+
     def __init__(self, beacon_id, url, data, parent, media):
         # url of the item
         self.url = url
         self.filename = ''
         # internal data
         self._beacon_id = beacon_id
-        # FIXME: ugly, maybe use the ObjectRow stuff from kaa.db
-        # with extra write support. Or copy on write.
-        self._beacon_data = dict(data)
-        self._beacon_tmpdata = {}
+        self._beacon_data = ItemData(data)
+        self._beacon_tmpdata = None
         self._beacon_parent = parent
         self._beacon_media = media
         self._beacon_isdir = False
-        self._beacon_changes = {}
+        self._beacon_changes = None
         self._beacon_name = data['name']
 
     def get(self, key, default=None):
@@ -66,6 +141,8 @@ class Item(object):
         the default value (None) will be returned.
         """
         if key.startswith('tmp:'):
+            if not self._beacon_tmpdata:
+                return default
             return self._beacon_tmpdata.get(key[4:], default)
         if key == 'parent':
             return self._beacon_parent
@@ -131,10 +208,13 @@ class Item(object):
         stored in the db.
         """
         if key.startswith('tmp:'):
+            if self._beacon_tmpdata is None:
+                self._beacon_tmpdata = {}
             self._beacon_tmpdata[key[4:]] = value
             return
         self._beacon_data[key] = value
         if not self._beacon_changes:
+            self._beacon_changes = {}
             self._beacon_controller._beacon_update(self)
         self._beacon_changes[key] = value
 
@@ -142,14 +222,14 @@ class Item(object):
         """
         List item attributes
         """
-        return self._beacon_data.keys() + self._beacon_tmpdata.keys()
+        return self._beacon_data.keys() + (self._beacon_tmpdata or {}).keys()
 
     def has_key(self, key):
         """
         Check if the item has a specific attribute set
         """
-        return key in self._beacon_data.keys() or \
-               key in self._beacon_tmpdata.keys()
+        return key in self._beacon_data or \
+               key in (self._beacon_tmpdata or {})
 
     @property
     def scanned(self):
@@ -231,10 +311,10 @@ class Item(object):
         Callback from db with new data
         """
         self._beacon_isdir = (data['type'] == 'dir')
-        self._beacon_data = dict(data)
+        self._beacon_data = ItemData(data)
         self._beacon_id = (data['type'], data['id'])
-        for key, value in self._beacon_changes.items():
-            self._beacon_data[key] = value
+        if self._beacon_changes:
+            self._beacon_data.update(self._beacon_changes)
 
     @property
     def _beacon_controller(self):
@@ -28,7 +28,9 @@
 
 
 # Python imports
+import re
 import copy
+import time
 import logging
 
 # kaa imports
@@ -42,6 +44,9 @@ log = logging.getLogger('beacon')
 
 _query_filter = {}
 
+# split item attributes into words for the search session
+_split_words = re.compile(r'[\W_]+', re.U).split
+
 def register_filter(name, function):
     """
     Register a filter for L{Query} or L{wrap} to process a list of items.
@@ -79,10 +84,15 @@ class Query(object):
         Query.NEXT_ID += 1
         # public variables
         self.result = []
+        # False if the query was created with a limit and there may be
+        # more results to fetch
+        self.complete = query.get('limit') is None
         # internal variables
         self._query = query
         self._client = client
         self._beacon_monitoring = False
+        self._beacon_priority = False
+        self._fetching = None
         # some shortcuts from the client
         self._rpc = self._client.rpc
         # InProgress object
@@ -107,13 +117,17 @@ class Query(object):
         """
         return self._beacon_monitoring
 
-    def monitor(self, enable=True):
+    def monitor(self, enable=True, priority=False):
         """
         Turn on/off query monitoring
+
+        :param priority: the query is visible to the user, the server
+            checks it for changes before other queries
         """
         if self._beacon_monitoring == enable:
             # Nothing to do
             return
+        self._beacon_priority = priority
         if self._client.connected:
             # If the client is not connected yet, Client._connected() will explicitly
             # call _monitor() on reconnect.
@@ -166,10 +180,42 @@ class Query(object):
             raise AttributeError('unknown filter')
         return _query_filter[filter](self.result)
 
+    def fetch(self):
+        """
+        Fetch the next page of results for a query created with a limit.
+        The new items are appended to the result and the progress signal
+        is emitted with the number of items fetched so far.
+
+        :returns: InProgress with the list of new items
+        """
+        if not self._fetching or self._fetching.finished:
+            self._fetching = self._beacon_fetch()
+        return self._fetching
+
     # -------------------------------------------------------------------------
     # Internal API
     # -------------------------------------------------------------------------
 
+    def _beacon_progress(self):
+        """
+        Emit the progress signal for a paginated query. The maximum is 0
+        as long as the query is not complete.
+        """
+        total = 0
+        if self.complete:
+            total = len(self.result)
+        self.signals['progress'].emit(len(self.result), total, None)
+
+    def _beacon_db_query(self):
+        """
+        Return the query for the database. For paginated queries all pages
+        fetched so far are requested.
+        """
+        query = self._query
+        if query.get('limit') is not None and len(self.result) > query['limit']:
+            query = dict(query, limit=len(self.result))
+        return query
+
     def _monitor(self, enable):
         """
         Enable/disable query monitoring without the public-facing checks.
@@ -184,7 +230,7 @@ class Query(object):
                     parent.scan().connect(self._monitor, enable)
                     return
                 query['parent'] = parent._beacon_id
-            self._rpc('monitor_add', self._client.id, self.id, query)
+            self._rpc('monitor_add', self._client.id, self.id, query, self._beacon_priority)
         else:
             self._rpc('monitor_remove', self._client.id, self.id)
 
@@ -219,10 +265,35 @@ class Query(object):
                 self.result = yield self.result
         finally:
             self._rpc('db_unlock')
+        if query.get('limit') is not None:
+            self.complete = len(self.result) < query['limit']
+            self._beacon_progress()
         self.signals['changed'].emit()
         if not self._async.finished:
             self._async.finish(True)
 
+    @kaa.coroutine()
+    def _beacon_fetch(self):
+        """
+        Fetch the next page from the database.
+        """
+        yield self._async
+        if self.complete:
+            yield []
+        query = dict(self._query, offset=len(self.result))
+        yield self._rpc('db_lock')
+        try:
+            items = self._client._db.query(**query)
+            if isinstance(items, kaa.InProgress):
+                items = yield items
+        finally:
+            self._rpc('db_unlock')
+        self.result = self.result + items
+        self.complete = len(items) < query['limit']
+        self._beacon_progress()
+        self.signals['changed'].emit()
+        yield items
+
     def __repr__(self):
         """
         Convert object to string (usefull for debugging)
@@ -254,7 +325,7 @@ class Query(object):
         # some time until it tries again. That time is too long, it
         # can take up to two seconds.
         yield self._rpc('db_lock')
-        result = self._client._db.query(**self._query)
+        result = self._client._db.query(**self._beacon_db_query())
         if isinstance(result, kaa.InProgress):
             result = yield result
         self._rpc('db_unlock')
@@ -284,3 +355,192 @@ class Query(object):
                 # a second signal to get information about internal changes
                 c._beacon_database_update(item._beacon_data)
         yield False
+
+
+class SearchSession(object):
+    """
+    Live keyword search for type-ahead input. Each call to update() refines
+    the search. If the new keywords extend the last ones, the current result
+    is filtered first and given back to the caller before the database
+    query is done. Only the first page is fetched from the database, call
+    fetch() to get the complete result. A search still running when
+    update() is called again is aborted. Created by Client.search()
+    """
+    # Number of items fetched from the database for each update
+    PAGE = 50
+
+    def __init__(self, client, latency=0.1, **query):
+        self.signals = kaa.Signals('changed', 'up-to-date')
+        # public variables
+        self.keywords = u''
+        self.result = []
+        self.complete = True
+        # internal variables
+        self._client = client
+        self._query = query
+        self._latency = latency
+        self._search = None
+        self._fetching = None
+        # result of the last finished search, the base for refinements
+        self._finished = []
+        # database query of the last finished search
+        self._db_query = None
+
+    def update(self, keywords):
+        """
+        Search for the given keywords. The changed signal is emitted every
+        time there are new (partial) results, up-to-date after the database
+        query is done.
+
+        :returns: InProgress with the result of the database query
+        """
+        keywords = kaa.str_to_unicode(keywords).strip().lower()
+        if self._search and not self._search.finished:
+            # The user is typing faster than we can search. The old
+            # search is not needed anymore.
+            self._search.abort()
+        if self._fetching and not self._fetching.finished:
+            self._fetching.abort()
+        previous, self.keywords = self.keywords, keywords
+        self._search = self._beacon_search(previous, keywords)
+        return self._search
+
+    def fetch(self):
+        """
+        Fetch the rest of the result of the last update() from the
+        database. The changed signal is emitted when done.
+
+        :returns: InProgress with the list of new items
+        """
+        if not self._fetching or self._fetching.finished:
+            self._fetching = self._beacon_fetch()
+        return self._fetching
+
+    def __iter__(self):
+        """
+        Iterate through the results.
+        """
+        return self.result.__iter__()
+
+    def __getitem__(self, pos):
+        """
+        Get a specific item in the results list.
+        """
+        return self.result[pos]
+
+    def __len__(self):
+        """
+        Get length of results.
+        """
+        return len(self.result)
+
+    def _beacon_match(self, item, terms):
+        """
+        Check if all terms are a prefix of a word in one of the item
+        attributes in the keywords index.
+        """
+        words = []
+        for attr, split in self._beacon_keyword_attrs(item._beacon_data.get('type')):
+            value = item._beacon_data.get(attr)
+            if value:
+                words.extend(kaa.str_to_unicode(w).lower() for w in (split or _split_words)(value))
+        for term in terms:
+            for word in words:
+                if word.startswith(term):
+                    break
+            else:
+                return False
+        return True
+
+    def _beacon_keyword_attrs(self, type):
+        """
+        Return the attributes of the type in the keywords index together
+        with their split function.
+        """
+        try:
+            attrs = self._client._db._db._object_types[type][1]
+        except (KeyError, AttributeError):
+            return [ ('name', None) ]
+        return [ (name, info[3]) for name, info in attrs.items() if info[2] == 'keywords' ]
+
+    @kaa.coroutine()
+    def _beacon_search(self, previous, keywords):
+        """
+        Search the database for the keywords.
+        """
+        if not keywords:
+            self.result = self._finished = []
+            self.complete = True
+            self._db_query = None
+            self.signals['changed'].emit()
+            self.signals['up-to-date'].emit()
+            yield self.result
+        if previous and keywords.startswith(previous) and self._finished:
+            # Refinement of the last search, filter what we already have.
+            # If this takes longer than the latency, give the partial result
+            # to the caller and continue in the next main loop step. The
+            # result of the last finished search is kept in case this
+            # search is aborted.
+            terms = [ term for term in _split_words(keywords) if term ]
+            self.result = []
+            timer = time.time()
+            for item in self._finished:
+                if self._beacon_match(item, terms):
+                    self.result.append(item)
+                if time.time() > timer + self._latency:
+                    self.signals['changed'].emit()
+                    yield kaa.NotFinished
+                    timer = time.time()
+            self.signals['changed'].emit()
+        if not self._client.connected:
+            # wait until the client is connected
+            yield kaa.inprogress(self._client.signals['connect'])
+        # Every term is a prefix, the last word may not be complete
+        # while the user is typing.
+        terms = [ term + '*' for term in _split_words(keywords) if term ]
+        query = dict(self._query, keywords=' '.join(terms))
+        query.setdefault('rank', True)
+        result = yield self._beacon_db_query(dict(query, limit=self.PAGE))
+        self.result = self._finished = result
+        self.complete = len(result) < self.PAGE
+        self._db_query = query
+        self.signals['changed'].emit()
+        self.signals['up-to-date'].emit()
+        yield self.result
+
+    @kaa.coroutine()
+    def _beacon_fetch(self):
+        """
+        Fetch the rest of the result from the database.
+        """
+        if self._search and not self._search.finished:
+            yield self._search
+        if self.complete or not self._db_query:
+            yield []
+        items = yield self._beacon_db_query(dict(self._db_query, offset=len(self.result)))
+        self.result = self._finished = self.result + items
+        self.complete = True
+        self.signals['changed'].emit()
+        yield items
+
+    @kaa.coroutine()
+    def _beacon_db_query(self, query):
+        """
+        Query the database while the server does not change it. The
+        db_unlock rpc must also be sent if the query is aborted while
+        waiting for the lock.
+        """
+        try:
+            yield self._client.rpc('db_lock')
+            result = self._client._db.query(**query)
+            if isinstance(result, kaa.InProgress):
+                result = yield result
+        finally:
+            self._client.rpc('db_unlock')
+        yield result
+
+    def __repr__(self):
+        """
+        Convert object to string (usefull for debugging)
+        """
+        return '<beacon.Client.SearchSession for %s>' % self.keywords
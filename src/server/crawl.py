@@ -32,11 +32,13 @@
 # python imports
 import os
 import time
+import heapq
 import logging
 
 # kaa imports
 import kaa
 from kaa.inotify import INotify
+from fanotify import FANotify
 
 # kaa.beacon imports
 from parser import parse, add_directory_attributes
@@ -55,6 +57,132 @@ try:
 except:
     WATCH_MASK = None
 
+# time in seconds inotify events are collected before they are handled
+EVENT_INTERVAL = 0.2
+
+# Minimum and maximum interval in seconds between two checks of a
+# directory on NFS/CIFS and the maximum number of directories checked
+# at once.
+REMOTE_MIN_INTERVAL = 10
+REMOTE_MAX_INTERVAL = 600
+REMOTE_BATCH = 200
+
+
+class RemoteMonitor(object):
+    """
+    Detect changes in directories on NFS or CIFS that are invisible to
+    INotify by checking the directory mtime. A directory that did not
+    change is checked with an exponentially growing interval, a changed
+    directory and its subdirectories are checked again soon. The mtime
+    of a directory does not change when a file is only modified, so
+    directories are scanned anyway when reaching the maximum interval.
+    """
+    def __init__(self):
+        # dirname -> [ item, mtime, interval, next check ]
+        self._dirs = {}
+        # dirname -> set of subdirectory names
+        self._children = {}
+        # heap of (next check, dirname), may contain outdated entries
+        self._heap = []
+
+
+    def __len__(self):
+        return len(self._dirs)
+
+
+    def add(self, dirname, item):
+        """
+        Add a directory to check.
+        """
+        if dirname in self._dirs:
+            self._dirs[dirname][0] = item
+            return
+        try:
+            mtime = os.stat(dirname).st_mtime
+        except OSError:
+            return
+        self._dirs[dirname] = [ item, mtime, REMOTE_MIN_INTERVAL, None ]
+        parent = os.path.dirname(dirname.rstrip('/')) + '/'
+        self._children.setdefault(parent, set()).add(dirname)
+        self._schedule(dirname, time.time() + REMOTE_MIN_INTERVAL)
+
+
+    def remove(self, dirname):
+        """
+        Remove the directory and all directories under it.
+        """
+        for d in [ d for d in self._dirs if d.startswith(dirname) ]:
+            del self._dirs[d]
+            self._children.pop(d, None)
+            parent = os.path.dirname(d.rstrip('/')) + '/'
+            if parent in self._children:
+                self._children[parent].discard(d)
+
+
+    def next(self):
+        """
+        Return the time in seconds until the next directory is due.
+        """
+        while self._heap and self._outdated(*self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return REMOTE_MAX_INTERVAL
+        return max(self._heap[0][0] - time.time(), REMOTE_MIN_INTERVAL)
+
+
+    def check(self):
+        """
+        Check all directories that are due and return the items that
+        need to be scanned.
+        """
+        t1 = now = time.time()
+        result = []
+        checked = 0
+        while self._heap and checked < REMOTE_BATCH and self._heap[0][0] <= now:
+            due, dirname = heapq.heappop(self._heap)
+            if self._outdated(due, dirname):
+                continue
+            checked += 1
+            info = self._dirs[dirname]
+            try:
+                mtime = os.stat(dirname).st_mtime
+            except OSError:
+                # gone, the scan of the parent directory will notice
+                self.remove(dirname)
+                continue
+            if mtime != info[1]:
+                # changed, check this directory and the subdirectories
+                # more often for some time
+                info[1] = mtime
+                info[2] = REMOTE_MIN_INTERVAL
+                result.append(info[0])
+                for child in self._children.get(dirname, ()):
+                    child_info = self._dirs.get(child)
+                    if child_info and child_info[3] > now + REMOTE_MIN_INTERVAL:
+                        child_info[2] = REMOTE_MIN_INTERVAL
+                        self._schedule(child, now + REMOTE_MIN_INTERVAL)
+            elif info[2] >= REMOTE_MAX_INTERVAL:
+                # no change for a long time, scan for modified files
+                result.append(info[0])
+            else:
+                info[2] = min(info[2] * 2, REMOTE_MAX_INTERVAL)
+            self._schedule(dirname, now + info[2])
+        if checked:
+            log.info('remote monitor: checked %d of %d directories in %0.3f seconds, '
+                     '%d to scan', checked, len(self._dirs), time.time() - t1, len(result))
+        return result
+
+
+    def _schedule(self, dirname, due):
+        self._dirs[dirname][3] = due
+        heapq.heappush(self._heap, (due, dirname))
+
+
+    def _outdated(self, due, dirname):
+        info = self._dirs.get(dirname)
+        return not info or info[3] != due
+
+
 
 class MonitorList(dict):
 
@@ -67,6 +195,8 @@ class MonitorList(dict):
         # contains subdirs foo/ and bar/, only /mnt/filer/ would be in this
         # list.
         self.nfs_items = []
+        # All directories on NFS or CIFS for change detection by mtime
+        self.remote = RemoteMonitor()
 
     def add(self, dirname, item, use_inotify=True):
         if self._inotify and use_inotify:
@@ -78,10 +208,12 @@ class MonitorList(dict):
                 log.error(e)
 
             # Is this dir on a network filesystem?
-            if not any(1 for i in self.nfs_items if dirname.startswith(i.filename)):
-                # Parent isn't already in rescan list, so check to see if this dir is NFS/CIFS.
-                if utils.statfs(dirname).f_type in ('nfs', 'smbfs'):
-                    self.nfs_items.append(item)
+            if any(1 for i in self.nfs_items if dirname.startswith(i.filename)):
+                self.remote.add(dirname, item)
+            elif utils.is_remote(dirname):
+                # Parent isn't already in rescan list, but this dir is NFS/CIFS.
+                self.nfs_items.append(item)
+                self.remote.add(dirname, item)
         else:
             self[dirname] = False
 
@@ -100,6 +232,7 @@ class MonitorList(dict):
 
         # Remove any NFS/CIFS items at or under this path.
         self.nfs_items = [i for i in self.nfs_items if not i.filename.startswith(dirname)]
+        self.remote.remove(dirname)
 
 
 
@@ -129,10 +262,17 @@ class Crawler(object):
 
         # set up inotify
         self._inotify = None
-        if use_inotify and monitor:
+        if use_inotify and monitor and config.fanotify:
+            # one filesystem wide watch instead of one per directory
+            try:
+                self._inotify = FANotify()
+                self._inotify.signals['event'].connect(self._inotify_buffer)
+            except SystemError, e:
+                log.warning('%s, using inotify', e)
+        if use_inotify and monitor and not self._inotify:
             try:
                 self._inotify = INotify()
-                self._inotify.signals['event'].connect(self._inotify_event)
+                self._inotify.signals['event'].connect(self._inotify_buffer)
             except SystemError, e:
                 log.warning('%s', e)
 
@@ -140,6 +280,10 @@ class Crawler(object):
         cb = kaa.WeakCallable(self._inotify_event, INotify.MODIFY)
         cb.init_args_first = True
         self._bursthandler = utils.BurstHandler(config.scheduler.growscan, cb)
+        # Collect inotify events for a short time to merge events for
+        # the same file (e.g. when copying many files)
+        cb = kaa.WeakCallable(self._inotify_batch)
+        self._events = utils.EventBuffer(EVENT_INTERVAL, cb, self._db.read_lock)
 
         # List of directories we are interested in monitoring (either with
         # INotify or by polling).
@@ -153,6 +297,9 @@ class Crawler(object):
         # create internal scan variables
         self._scan_list = []
         self._scan_dict = {}
+        # scanned directories needing an update of the directory
+        # attributes, mapping database id to directory
+        self._scan_attributes = {}
         # CoroutineInProgress for self._scanner
         self._coroutine = None
         if monitor:
@@ -198,9 +345,9 @@ class Crawler(object):
     # Internal functions - INotify
     # -------------------------------------------------------------------------
 
-    def _inotify_event(self, mask, name, target=None):
+    def _inotify_buffer(self, mask, name, target=None):
         """
-        Callback for inotify.
+        Callback for inotify. The event is added to the event buffer.
         """
         if mask & INotify.MODIFY and self._bursthandler.is_growing(name):
             # A file was modified. Do this check as fast as we can because the
@@ -209,7 +356,23 @@ class Crawler(object):
             # much CPU time in the burst, but there is nothing we can do about
             # it.
             return True
+        self._events.add(mask, name, target)
+        return True
+
+
+    def _inotify_batch(self, events):
+        """
+        Callback from the event buffer with a list of merged events.
+        """
+        log.info('crawler %d: handle %d inotify events', self.num, len(events))
+        for mask, name, target in events:
+            self._inotify_event(mask, name, target)
+
 
+    def _inotify_event(self, mask, name, target=None):
+        """
+        Handle an inotify event.
+        """
         if self._db.read_lock.locked:
             # The database is locked now and we may want to change entries.
             # When the db becomes unlocked, INotify events will be replayed in
@@ -260,7 +423,6 @@ class Crawler(object):
                 changes['parent'] = move._beacon_parent._beacon_id
             if item._beacon_data['name'] != move._beacon_data['name']:
                 # New name, set name to item
-                move._beacon_data = dict(move._beacon_data)
                 if move._beacon_data.get('image') == move._beacon_data['name']:
                     # update image to new filename
                     changes['image'] = move._beacon_data['name']
@@ -426,19 +588,53 @@ class Crawler(object):
 
             subdirs = yield ip
             if recursive:
-                # add results to the list of files to scan
+                # add results to the list of files to scan. A forced scan is
+                # only for the directory itself, subdirectories already
+                # monitored are skipped.
                 for d in subdirs:
-                    self._scan_add(d, True, throttle, force_thumbnail_check, force_scan)
+                    self._scan_add(d, True, throttle, force_thumbnail_check)
+
+            if not self._scan_list and self._scan_attributes:
+                # All directories are scanned, update the directory
+                # attributes once for each changed directory.
+                yield self._update_directory_attributes()
 
         self._scan_completed(aborted=False)
 
-        if (not self._inotify or (self.monitors.nfs_items and config.scheduler.nfsrescan)) and self._scan_restart_timer:
-            # We need to schedule a rescan either because INotify is not in use or because we
-            # have NFS directories that need to be polled.  Start crawling again in 10 seconds.
-            # During a rescan, the scanner will slow down even beyond what the scheduler
-            # dictates.
+        if not self._inotify and self._scan_restart_timer:
+            # We need to schedule a rescan because INotify is not in use.  Start
+            # crawling again in 10 seconds.  During a rescan, the scanner will slow
+            # down even beyond what the scheduler dictates.
             log.debug('crawler %d: scheduling a rescan', self.num)
             self._scan_restart_timer.start(10)
+        elif self.monitors.remote and config.scheduler.nfsrescan and self._scan_restart_timer:
+            # We have NFS directories that need to be polled.
+            self._scan_restart_timer.start(self.monitors.remote.next())
+
+
+    @kaa.coroutine()
+    def _update_directory_attributes(self):
+        """
+        Update the attributes of all scanned directories bottom-up. A
+        directory is checked again when one of its subdirectories changed
+        and every directory is only checked once.
+        """
+        heap = []
+        for directory in self._scan_attributes.values():
+            # the deepest directories first
+            depth = (directory._beacon_data.get('path') or '').count('/')
+            heapq.heappush(heap, (-depth, id(directory), directory))
+        self._scan_attributes = {}
+        done = set()
+        while heap:
+            depth, unused, directory = heapq.heappop(heap)
+            if directory._beacon_id in done:
+                continue
+            done.add(directory._beacon_id)
+            changed = yield add_directory_attributes(self._db, directory)
+            parent = directory._beacon_parent
+            if changed and parent and parent._beacon_isdir and parent._beacon_id:
+                heapq.heappush(heap, (depth + 1, id(parent), parent))
 
 
     def _scan_completed(self, aborted=True):
@@ -468,12 +664,15 @@ class Crawler(object):
             self.monitors = MonitorList(self._inotify)
             for item in self._root_items:
                 self._scan_add(item, recursive=True, throttle=True)
-        elif self.monitors.nfs_items:
-            # Force rescan NFS/CIFS directories.  These are already being
-            # monitored with INotify so we don't clear the MonitorList as with
-            # the non-INotify case above.
-            for item in self.monitors.nfs_items[:]:
+        elif self.monitors.remote:
+            # Force rescan changed NFS/CIFS directories.  These are already
+            # being monitored with INotify so we don't clear the MonitorList
+            # as with the non-INotify case above.
+            for item in self.monitors.remote.check():
                 self._scan_add(item, recursive=True, throttle=True, force_scan=True)
+            if not self._coroutine or self._coroutine.finished:
+                # nothing to scan, the scanner will not restart the timer
+                self._scan_restart_timer.start(self.monitors.remote.next())
 
 
     @kaa.coroutine()
@@ -556,10 +755,10 @@ class Crawler(object):
             if child._beacon_isdir:
                 self.monitors.remove(child.filename)
 
-        if not subdirs:
-            # No subdirectories that need to be checked. Add some extra
-            # attributes based on the found items (recursive back to parents)
-            yield add_directory_attributes(self._db, directory)
+        # Add some extra attributes based on the found items when all
+        # directories are scanned (bottom-up to the parents)
+        if directory._beacon_id:
+            self._scan_attributes[directory._beacon_id] = directory
         yield subdirs
 
 
@@ -32,6 +32,9 @@
 # python imports
 import logging
 import time
+import stat
+import weakref
+from collections import OrderedDict
 
 # kaa imports
 import kaa
@@ -40,13 +43,25 @@ from kaa.db import *
 
 # beacon imports
 from ..item import Item
-from ..db import Database as RO_Database, create_directory
+from ..db import Database as RO_Database, create_directory, MAX_IN_QUERY, _path_range
 
 # get logging object
 log = logging.getLogger('beacon.db')
 
 MAX_BUFFER_CHANGES = 200
 
+# Maximum number of database rows in the parent cache
+MAX_PARENT_CACHE = 10000
+
+# Time in seconds deleted objects are remembered to detect a file moved
+# to a different location and the maximum number of them
+TOMBSTONE_TTL = 300
+MAX_TOMBSTONES = 5000
+
+# Attributes of a deleted object not restored when the file shows up
+# again at a different location
+TOMBSTONE_IGNORE = ('id', 'type', 'name', 'parent', 'media', 'path')
+
 class ReadLock(object):
     """
     Read lock for the database.
@@ -128,6 +143,66 @@ class ReadLock(object):
 
 
 
+class ChangeSet(object):
+    """
+    Immutable set of changed objects emitted by the changed signal of
+    the Database. The (type, id) tuples are grouped by type and every
+    object has the kind of the change: add, update, or delete. The same
+    object is shared between all receivers of the signal.
+    """
+    def __init__(self, changes):
+        """
+        Create the set from a list of (kind, (type, id)) tuples.
+        """
+        self._types = {}
+        self._len = 0
+        for kind, (type, id) in changes:
+            ids = self._types.setdefault(type, {})
+            if not id in ids:
+                self._len += 1
+            elif kind == 'update':
+                # an added or deleted object is still added or deleted
+                continue
+            ids[id] = kind
+
+    def types(self):
+        """
+        Return the list of changed object types.
+        """
+        return self._types.keys()
+
+    def ids(self, type, kind=None):
+        """
+        Return the ids of the changed objects with the given type. If
+        kind is given, only the ids of this kind of change are returned.
+        """
+        ids = self._types.get(type, {})
+        if kind is None:
+            return ids.keys()
+        return [ id for id, k in ids.items() if k == kind ]
+
+    def kind(self, (type, id)):
+        """
+        Return the kind of change for the (type, id) tuple or None if
+        the object is not in the set.
+        """
+        return self._types.get(type, {}).get(id)
+
+    def __contains__(self, (type, id)):
+        return id in self._types.get(type, ())
+
+    def __iter__(self):
+        for type, ids in self._types.items():
+            for id in ids:
+                yield type, id
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return '<ChangeSet %s>' % ', '.join([ '%s: %d' % (t, len(i)) for t, i in self._types.items() ])
+
+
 class Database(RO_Database):
     """
     A kaa.db based database.
@@ -140,9 +215,9 @@ class Database(RO_Database):
 
             .. describe:: def callback(changes)
 
-               :param changes: list of kaa.db ids (2-tuple of (type, id)) for
-                               the objects that have been added, removed, or
-                               updated in the database.
+               :param changes: ChangeSet with the kaa.db ids (2-tuple of
+                               (type, id)) for the objects that have been
+                               added, removed, or updated in the database.
             '''
     }
 
@@ -152,14 +227,26 @@ class Database(RO_Database):
         """
         super(Database,self).__init__(dbdir)
 
-        # handle changes in a list and add them to the database
-        # on commit.
+        # handle changes in a list of (kind, (type, id)) and add them
+        # to the database on commit.
         self.changes = []
 
         # server lock when a client is doing something
         self.read_lock = ReadLock()
         self.read_lock.signals['locked'].connect_weak(self.commit)
 
+        # the server knows about all changes, enable the parent cache
+        # and the shared parent objects
+        self._parent_cache = {}
+        self._objects = weakref.WeakValueDictionary()
+        self.signals['changed'].connect_weak(self._parent_cache_changed)
+        self._facet_cache = {}
+        self.signals['changed'].connect_weak(self._facet_cache_changed)
+
+        # recently deleted objects, mapping (name, mtime) and hash to
+        # [ timestamp, type, attributes ]
+        self._tombstones = OrderedDict()
+
         # register basic types
         self._db.register_inverted_index('keywords', min = 2, max = 30)
         self._db.register_object_type_attrs('dir',
@@ -169,6 +256,7 @@ class Database(RO_Database):
             [('name', 'parent_type', 'parent_id')],
             name = (str, ATTR_SEARCHABLE | ATTR_INVERTED_INDEX, 'keywords', db.split_path),
             media = (int, ATTR_SEARCHABLE | ATTR_INDEXED),
+            path = (str, ATTR_SEARCHABLE | ATTR_INDEXED),
             image = (str, ATTR_SIMPLE),
             mtime = (int, ATTR_SIMPLE))
 
@@ -176,8 +264,13 @@ class Database(RO_Database):
             [('name', 'parent_type', 'parent_id')],
             name = (str, ATTR_SEARCHABLE | ATTR_INVERTED_INDEX, 'keywords', db.split_path),
             media = (int, ATTR_SEARCHABLE | ATTR_INDEXED),
+            path = (str, ATTR_SEARCHABLE | ATTR_INDEXED),
             image = (str, ATTR_SIMPLE),
-            mtime = (int, ATTR_SIMPLE))
+            mtime = (int, ATTR_SIMPLE),
+            inode = (int, ATTR_SIMPLE),
+            device = (int, ATTR_SIMPLE),
+            size = (int, ATTR_SIMPLE),
+            file_mtime = (int, ATTR_SIMPLE))
 
         self._db.register_object_type_attrs('media',
             [('name', 'parent_type', 'parent_id')],
@@ -236,11 +329,40 @@ class Database(RO_Database):
         log.info('*** db.commit %d items: %.5f' % (len(self.changes), t2-t1))
 
         # fire db changed signal
-        changes = self.changes
+        changes = ChangeSet(self.changes)
         self.changes = []
         self.signals['changed'].emit(changes)
 
 
+    def _parent_cache_changed(self, changes):
+        """
+        Remove changed objects from the parent cache and the shared
+        parent objects.
+        """
+        self._db_invalidate_objects(changes)
+        if len(self._parent_cache) > MAX_PARENT_CACHE:
+            self._parent_cache = {}
+            return
+        for entry in changes:
+            self._parent_cache.pop(entry, None)
+
+
+    def _facet_cache_changed(self, changes):
+        """
+        Remove the cached attribute queries for all changed types.
+        """
+        if 'media' in changes.types() or \
+               [ t for t in changes.types() if changes.ids(t, 'delete') ]:
+            # All objects of a media may be gone. A deleted directory is
+            # only reported itself, not the objects below it.
+            self._facet_cache = {}
+            return
+        for type in changes.types():
+            self._facet_cache.pop(type, None)
+        # queries without type include all types
+        self._facet_cache.pop(None, None)
+
+
     def sync_item(self, item):
         """
         Sync item with current db information.
@@ -270,8 +392,14 @@ class Database(RO_Database):
             kwargs['media'] = kwargs.get('parent')._beacon_media._beacon_id[1]
             kwargs['parent'] = kwargs.get('parent')._beacon_id
 
+        if kwargs.get('parent') and type != 'media':
+            # The parent item may be older than the last move, get the
+            # path from the database. The row stays in the parent cache
+            # for the next object in the same directory.
+            kwargs['path'] = self._db_path(kwargs['parent'])
+
         result = self._db.add(type, **kwargs)
-        self.changes.append((result['type'], result['id']))
+        self.changes.append(('add', (result['type'], result['id'])))
         if len(self.changes) > MAX_BUFFER_CHANGES:
             self.commit()
         return result
@@ -292,12 +420,22 @@ class Database(RO_Database):
 
         if 'media' in kwargs:
             del kwargs['media']
+        if 'parent' in kwargs:
+            # The object is moved, all objects below it need a new path
+            old = self._db_path((type, id))
+            kwargs['path'] = self._db_path(kwargs['parent'])
         try:
             self._db.update((type, id), **kwargs)
         except AssertionError, e:
             log.exception('update (%s,%s)', type, id)
             raise e
-        self.changes.append((type, id))
+        # Forget the cached row and the shared object now, a query before
+        # the next commit must not get the old parent.
+        self._parent_cache.pop((type, id), None)
+        self._db_invalidate_objects([ (type, id) ])
+        if 'parent' in kwargs:
+            self._move_subtree(old, self._db_path((type, id)))
+        self.changes.append(('update', (type, id)))
         if len(self.changes) > MAX_BUFFER_CHANGES:
             self.commit()
 
@@ -310,11 +448,84 @@ class Database(RO_Database):
         if self.read_lock.locked:
             raise IOError('database is locked')
 
+        old = self._db_path(obj)
         try:
-            return self._db.retype(obj, new_type)
+            data = self._db.retype(obj, new_type)
         except ValueError:
             # object doesn't exist, already changed by something?
-            pass
+            return None
+        self._parent_cache.pop(tuple(obj), None)
+        self._db_invalidate_objects([ tuple(obj) ])
+        # the object has a new type and id, update the path of all
+        # objects below it.
+        self._move_subtree(old, self._db_path((data['type'], data['id'])))
+        return data
+
+
+    def _path_types(self):
+        """
+        Return the list of object types with a path attribute.
+        """
+        return [ type for type, (type_id, attrs, indexes) in self._db._object_types.items() \
+                 if 'path' in attrs ]
+
+
+    def _move_subtree(self, old, new):
+        """
+        Replace the path prefix old with new for all objects below it.
+        """
+        if old is None or old == new:
+            return
+        for type in self._path_types():
+            # kaa.db has no update based on a query, change the column
+            # of all objects of this type in the subtree directly. kaa.db
+            # stores str attributes as BLOB, the parameters and the result
+            # must be BLOBs or nothing matches.
+            self._db._db_query('UPDATE objects_%s SET path=CAST(? || substr(path, ?) AS BLOB) '
+                               'WHERE path >= ? AND path < ?' % type,
+                               (buffer(new), len(old) + 1, buffer(old), buffer(old + '\xff')))
+            # Make sure the subtree is found with the new path. If not,
+            # rewrite the rows through kaa.db.
+            for r in self._db.query(type=type, path=_path_range(old),
+                                    attrs=['id', 'path']):
+                log.error('path of %s:%d not moved, update it', type, r['id'])
+                self._db.update((type, r['id']), path=new + str(r['path'])[len(old):])
+        # cached rows and shared objects below it may have the old path
+        self._parent_cache.clear()
+        self._db_invalidate_objects()
+
+
+    def update_paths(self):
+        """
+        Set the path attribute for all objects in databases created
+        before the attribute was added. This function does nothing if
+        the database is up to date.
+        """
+        if self.get_metadata('beacon::path') == '1':
+            return
+        log.info('add path to all objects')
+        parents = {}
+        for type in self._path_types():
+            for r in self._db.query(type=type):
+                parents[(r['type'], r['id'])] = r['parent']
+        paths = {}
+        for entry in parents:
+            # walk up until we find an object with known path
+            chain = []
+            while entry not in paths:
+                parent = parents.get(entry)
+                if not parent or parent not in parents:
+                    # child of a media or no parent at all
+                    paths[entry] = parent and '%s:%d/' % parent or ''
+                    break
+                chain.append(entry)
+                entry = parent
+            for child in reversed(chain):
+                paths[child] = paths[parents[child]] + '%s:%d/' % parents[child]
+        for entry, path in paths.items():
+            self._db.update(entry, path=path)
+        self.set_metadata('beacon::path', '1')
+        self._db.commit()
 
 
     def register_inverted_index(self, name, *args, **kwargs):
@@ -332,9 +543,17 @@ class Database(RO_Database):
         kwargs['name'] = (str, ATTR_SEARCHABLE | ATTR_INVERTED_INDEX, 'keywords', db.split_path)
         # TODO: mtime may not e needed for subitems like tracks
         kwargs['media'] = (int, ATTR_SEARCHABLE | ATTR_INDEXED)
+        kwargs['path'] = (str, ATTR_SEARCHABLE | ATTR_INDEXED)
         if not type.startswith('track_'):
             kwargs['mtime'] = (int, ATTR_SIMPLE)
             kwargs['image'] = (str, ATTR_SIMPLE)
+            # stat information of the file to detect changes and moves
+            kwargs['inode'] = (int, ATTR_SIMPLE)
+            kwargs['device'] = (int, ATTR_SIMPLE)
+            kwargs['size'] = (int, ATTR_SIMPLE)
+            # mtime of the file itself, mtime includes the mtime of
+            # files belonging to it (e.g. cover images)
+            kwargs['file_mtime'] = (int, ATTR_SIMPLE)
         if not indexes:
             indexes = [("name", "parent_type", "parent_id")]
         return self._db.register_object_type_attrs(type, indexes, *args, **kwargs)
@@ -345,11 +564,110 @@ class Database(RO_Database):
         Helper function for delete_object.
         """
         log.info('delete %s', entry)
-        for child in self._db.query(parent = entry):
-            self._delete_object_recursive((child['type'], child['id']))
+        rows = []
+        if entry[0] == 'media':
+            path = self._db_path(entry)
+        else:
+            rows = self._db.query(type=entry[0], id=entry[1])
+            self._bury(rows)
+            path = None
+            if rows and rows[0].get('path') is not None:
+                path = '%s%s:%d/' % ((rows[0]['path'],) + tuple(entry))
+        if path is not None:
+            for type in self._path_types():
+                if type != 'dir' and not type.startswith('track_'):
+                    self._bury(self._db.query(type=type, limit=MAX_TOMBSTONES, path=_path_range(path)))
+            # delete all objects below entry with one query per type
+            for type in self._path_types():
+                self._db.delete_by_query(type=type, path=_path_range(path))
+            # cached rows of the deleted children are invalid now
+            self._parent_cache.clear()
+        elif rows:
+            # The path is not set before update_paths() is done, walk
+            # through the children.
+            self._delete_children(entry)
+            self._parent_cache.clear()
         # FIXME: if the item has a thumbnail, delete it!
         self._db.delete(entry)
-        self.changes.append(entry)
+        # Only the root of the subtree is added to the list of
+        # changes. All objects below it are gone and a monitor has to
+        # query again in any case.
+        self.changes.append(('delete', entry))
+
+
+    def _delete_children(self, entry):
+        """
+        Delete all objects below entry recursively without using the
+        path attribute.
+        """
+        for child in self._db.query(parent=entry):
+            if child['type'] != 'dir' and not child['type'].startswith('track_'):
+                self._bury([ child ])
+            self._delete_children((child['type'], child['id']))
+            self._db.delete((child['type'], child['id']))
+
+
+    def _bury(self, rows):
+        """
+        Remember deleted files for some time. If a file with the same
+        name, mtime and size or the same hash is added again, it was
+        moved and the old attributes can be used again.
+        """
+        now = time.time()
+        for row in rows:
+            if row['type'] == 'dir' or not row.get('mtime'):
+                continue
+            attrs = self._db._object_types[row['type']][1]
+            data = {}
+            for key in attrs:
+                if key not in TOMBSTONE_IGNORE and row.get(key) is not None:
+                    data[key] = row[key]
+            tombstone = [ now, row['type'], data, row['name'] ]
+            keys = []
+            if row.get('size') is not None:
+                keys.append((row['name'], row['mtime'], row['size']))
+            if row.get('hash'):
+                keys.append(row['hash'])
+            if row.get('inode'):
+                keys.append((row.get('device'), row['inode'], row.get('size')))
+            for key in keys:
+                # keep the dict sorted by time
+                self._tombstones.pop(key, None)
+                self._tombstones[key] = tombstone
+        while len(self._tombstones) > MAX_TOMBSTONES:
+            self._tombstones.popitem(last=False)
+
+
+    def exhume(self, name, mtime, hash=None, statinfo=None):
+        """
+        Return (type, attributes, old name) of a recently deleted file
+        with the same device, inode and size from the given stat result,
+        the given hash or the same name, mtime and size. Returns None if
+        there is no such file.
+        """
+        # forget old tombstones, the oldest are at the beginning
+        timeout = time.time() - TOMBSTONE_TTL
+        while self._tombstones:
+            key, tombstone = self._tombstones.iteritems().next()
+            if tombstone[0] > timeout:
+                break
+            del self._tombstones[key]
+        tombstone = None
+        if statinfo:
+            key = statinfo[stat.ST_DEV], statinfo[stat.ST_INO], statinfo[stat.ST_SIZE]
+            tombstone = self._tombstones.pop(key, None)
+        if hash and not tombstone:
+            tombstone = self._tombstones.pop(hash, None)
+        if statinfo and not tombstone:
+            tombstone = self._tombstones.pop((name, mtime, statinfo[stat.ST_SIZE]), None)
+        if not tombstone or tombstone[0] is None:
+            return None
+        timestamp, type, data, name = tombstone
+        # the tombstone may have two keys, it can only be used once
+        tombstone[0] = None
+        if type not in self._db._object_types:
+            return None
+        return type, data.copy(), name
 
 
     def delete_object(self, entry):
@@ -369,18 +687,45 @@ class Database(RO_Database):
             self.commit()
 
 
-    def delete_media(self, id):
+    @kaa.coroutine()
+    def delete_media(self, id, callback=None):
         """
-        Delete media with the given id.
+        Delete media with the given id. The objects are deleted in
+        chunks per type and the main loop keeps running between them.
+        If callback is given, it is called with the number of deleted
+        objects and the total number after each chunk.
         """
         log.info('delete media %s', id)
-        for child in self._db.query(media = id):
-            entry = (str(child['type']), child['id'])
-            # FIXME: if the item has a thumbnail, delete it!
-            self._db.delete(entry)
-            self.changes.append(entry)
+        objects = []
+        for type, (type_id, attrs, indexes) in self._db._object_types.items():
+            if 'media' in attrs and type != 'media':
+                ids = [ r['id'] for r in self._db.query(type=type, media=id, attrs=['id']) ]
+                if ids:
+                    objects.append((type, ids))
+        total = sum([ len(ids) for type, ids in objects ])
+        deleted = 0
+        for type, ids in objects:
+            for pos in range(0, len(ids), MAX_IN_QUERY):
+                if self.read_lock.locked:
+                    # a client is reading, wait before changing the db
+                    yield kaa.inprogress(self.read_lock)
+                chunk = ids[pos:pos+MAX_IN_QUERY]
+                # FIXME: if the item has a thumbnail, delete it!
+                self._db.delete_by_query(type=type, id=db.QExpr('in', chunk))
+                self._db.commit()
+                deleted += len(chunk)
+                if callback:
+                    callback(deleted, total)
+                yield kaa.NotFinished
+        if self.read_lock.locked:
+            yield kaa.inprogress(self.read_lock)
         self._db.delete(('media', id))
-        self.changes.append(('media', id))
+        # all objects of the media are gone, drop all cached rows
+        self._parent_cache.clear()
+        self._db_invalidate_objects()
+        # Only the media is added to the list of changes, the monitors
+        # have to query again in any case.
+        self.changes.append(('delete', ('media', id)))
         self.commit()
 
 
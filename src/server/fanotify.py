@@ -0,0 +1,268 @@
+# -*- coding: iso-8859-1 -*-
+# -----------------------------------------------------------------------------
+# fanotify.py - Filesystem wide change notification
+# -----------------------------------------------------------------------------
+# $Id$
+#
+# -----------------------------------------------------------------------------
+# kaa.beacon.server - A virtual filesystem with metadata
+# Copyright (C) 2006-2009 Dirk Meyer
+#
+# First Edition: Dirk Meyer <https://github.com/Dischi>
+# Maintainer:    Dirk Meyer <https://github.com/Dischi>
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'FANotify' ]
+
+# python imports
+import os
+import errno
+import struct
+import logging
+import ctypes, ctypes.util
+
+# kaa imports
+import kaa
+
+# kaa.beacon imports
+import utils
+
+# get logging object
+log = logging.getLogger('beacon.fanotify')
+
+# fanotify_init flags
+FAN_CLOEXEC = 0x01
+FAN_NONBLOCK = 0x02
+FAN_CLASS_NOTIF = 0x00
+FAN_REPORT_DFID_NAME = 0x400 | 0x800
+
+# fanotify_mark flags
+FAN_MARK_ADD = 0x01
+FAN_MARK_FILESYSTEM = 0x100
+
+# Event bits. They have the same values as the inotify bits, so the
+# events can be handled like INotify events.
+FAN_MODIFY = 0x00000002
+FAN_CLOSE_WRITE = 0x00000008
+FAN_MOVED_FROM = 0x00000040
+FAN_MOVED_TO = 0x00000080
+FAN_CREATE = 0x00000100
+FAN_DELETE = 0x00000200
+FAN_DELETE_SELF = 0x00000400
+FAN_ONDIR = 0x40000000
+
+FAN_EVENTS = FAN_MODIFY | FAN_CLOSE_WRITE | FAN_MOVED_FROM | FAN_MOVED_TO | \
+             FAN_CREATE | FAN_DELETE | FAN_DELETE_SELF
+
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+
+AT_FDCWD = -100
+O_PATH = 010000000
+
+# struct fanotify_event_metadata and struct fanotify_event_info_header
+EVENT_METADATA = struct.Struct('IBBHQii')
+INFO_HEADER = struct.Struct('BBH')
+
+# maximum number of cached directory names for file handles
+MAX_HANDLES = 10000
+
+class FANotify(object):
+    """
+    Filesystem wide change notification with the same interface as
+    kaa.inotify.INotify. Instead of one watch per directory, one mark
+    for the whole filesystem is added and events are filtered by the
+    watched directories. This needs CAP_SYS_ADMIN; SystemError is raised
+    if fanotify can not be used.
+    """
+
+    def __init__(self):
+        self._fd = -1
+        # device -> file descriptor of a directory on that filesystem
+        self._mounts = {}
+        self.signals = kaa.Signals('event')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._libc.fanotify_mark.argtypes = [ ctypes.c_int, ctypes.c_uint,
+                ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p ]
+            self._fd = self._libc.fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC |
+                FAN_NONBLOCK | FAN_REPORT_DFID_NAME, os.O_RDONLY)
+        except AttributeError:
+            raise SystemError('fanotify not supported by libc')
+        if self._fd < 0:
+            raise SystemError('fanotify: %s' % os.strerror(ctypes.get_errno()))
+        # watched directory names
+        self._watches = set()
+        # filesystem id -> file descriptor of a directory on that filesystem
+        self._fsids = {}
+        # file handle -> directory name
+        self._handles = {}
+        self._mask = 0
+        # pending moved from event: mask, path, watched
+        self._moved_from = None
+        self._moved_timer = kaa.WeakOneShotTimer(self._emit_moved_from)
+        self._monitor = kaa.IOMonitor(self._handle_data)
+        self._monitor.register(self._fd)
+
+
+    def __del__(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+        for fd in self._mounts.values():
+            os.close(fd)
+
+
+    def watch(self, path, mask):
+        """
+        Watch the given directory. The filesystem of the directory is
+        marked on the first watch. IOError is raised on failure.
+        """
+        path = path.rstrip('/') or '/'
+        device = os.stat(path).st_dev
+        if device not in self._mounts:
+            mask = (mask & FAN_EVENTS) | FAN_ONDIR
+            if self._libc.fanotify_mark(self._fd, FAN_MARK_ADD | FAN_MARK_FILESYSTEM,
+                                        mask, AT_FDCWD, path) < 0:
+                code = ctypes.get_errno()
+                raise IOError(code, '%s: %s' % (os.strerror(code), path))
+            log.info('fanotify: watching filesystem of %s', path)
+            self._mounts[device] = os.open(path, os.O_RDONLY)
+            self._fsids[utils.statfs(path).f_fsid] = self._mounts[device]
+        self._watches.add(path)
+
+
+    def ignore(self, path):
+        """
+        Stop watching the given directory. The filesystem mark stays.
+        """
+        self._watches.discard(path.rstrip('/') or '/')
+
+
+    def _resolve(self, fsid, handle):
+        """
+        Return the directory name for the file handle on the filesystem
+        with the given id. The names are cached, every write on the
+        filesystem creates an event, not only in watched directories.
+        """
+        dirname = self._handles.get((fsid, handle))
+        if dirname is not None:
+            return dirname
+        mount = self._fsids.get(fsid)
+        if mount is None:
+            return None
+        buf = ctypes.create_string_buffer(handle, len(handle))
+        fd = self._libc.open_by_handle_at(mount, buf, O_PATH)
+        if fd < 0:
+            # directory is deleted (ESTALE) or not accessible
+            return None
+        try:
+            dirname = os.readlink('/proc/self/fd/%d' % fd)
+        finally:
+            os.close(fd)
+        if len(self._handles) > MAX_HANDLES:
+            self._handles = {}
+        self._handles[(fsid, handle)] = dirname
+        return dirname
+
+
+    def _handle_data(self):
+        """
+        Read and emit all events.
+        """
+        try:
+            data = os.read(self._fd, 65536)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                log.error('fanotify: %s', e)
+            return
+        pos = 0
+        while pos + EVENT_METADATA.size <= len(data):
+            event_len, vers, reserved, metadata_len, mask, fd, pid = \
+                       EVENT_METADATA.unpack_from(data, pos)
+            if event_len < EVENT_METADATA.size:
+                break
+            info, end = pos + metadata_len, pos + event_len
+            pos = end
+            if fd >= 0:
+                os.close(fd)
+            while info + INFO_HEADER.size <= end:
+                info_type, pad, info_len = INFO_HEADER.unpack_from(data, info)
+                if not info_len:
+                    break
+                if info_type == FAN_EVENT_INFO_TYPE_DFID_NAME:
+                    # header, fsid (8 bytes), struct file_handle, name
+                    fsid = struct.unpack_from('Q', data, info + 4)[0]
+                    size = struct.unpack_from('I', data, info + 12)[0]
+                    handle = data[info + 12:info + 20 + size]
+                    name = data[info + 20 + size:info + info_len].split('\0', 1)[0]
+                    if mask & FAN_ONDIR and mask & (FAN_MOVED_FROM | FAN_MOVED_TO |
+                                                    FAN_DELETE | FAN_DELETE_SELF):
+                        # a directory is moved or deleted, the cached
+                        # names may be wrong now
+                        self._handles = {}
+                    dirname = self._resolve(fsid, handle)
+                    if dirname:
+                        watched = dirname in self._watches
+                        if name and name != '.':
+                            dirname = os.path.join(dirname, name)
+                        self._event(mask, dirname, watched)
+                info += info_len
+
+
+    def _event(self, mask, path, watched):
+        """
+        Emit the event for the path if its directory is watched. Like
+        kaa.inotify.INotify a moved from event directly followed by a
+        moved to event is emitted as one move event with the target.
+        fanotify has no cookie to match both, but the kernel queues
+        them together for a rename.
+        """
+        if mask & FAN_MOVED_FROM:
+            self._emit_moved_from()
+            self._moved_from = mask, path, watched
+            self._moved_timer.start(0.1)
+            return
+        if mask & FAN_MOVED_TO and self._moved_from:
+            from_mask, from_path, from_watched = self._moved_from
+            self._moved_from = None
+            self._moved_timer.stop()
+            if from_watched and watched:
+                self.signals['event'].emit(from_mask | FAN_MOVED_TO, from_path, path)
+            elif from_watched:
+                self.signals['event'].emit(from_mask, from_path)
+            elif watched:
+                self.signals['event'].emit(mask, path)
+            return
+        self._emit_moved_from()
+        if watched:
+            self.signals['event'].emit(mask, path)
+
+
+    def _emit_moved_from(self):
+        """
+        Emit a pending moved from event without moved to event, e.g.
+        if the target directory could not be resolved.
+        """
+        if not self._moved_from:
+            return
+        mask, path, watched = self._moved_from
+        self._moved_from = None
+        self._moved_timer.stop()
+        if watched:
+            self.signals['event'].emit(mask, path)
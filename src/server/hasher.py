@@ -0,0 +1,172 @@
+# -*- coding: iso-8859-1 -*-
+# -----------------------------------------------------------------------------
+# hasher.py - Content hashes to detect duplicate and moved files
+# -----------------------------------------------------------------------------
+# $Id$
+#
+# -----------------------------------------------------------------------------
+# kaa.beacon.server - A virtual filesystem with metadata
+# Copyright (C) 2006-2009 Dirk Meyer
+#
+# First Edition: Dirk Meyer <https://github.com/Dischi>
+# Maintainer:    Dirk Meyer <https://github.com/Dischi>
+#
+# Please see the file AUTHORS for a complete list of authors.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MER-
+# CHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+#
+# -----------------------------------------------------------------------------
+
+__all__ = [ 'Hasher', 'hash_thread', 'full_hash_thread', 'find_moved', 'HASH_TYPES' ]
+
+# python imports
+import os
+import logging
+import hashlib
+
+# kaa imports
+import kaa
+
+# kaa.beacon imports
+from config import config
+import scheduler
+
+# get logging object
+log = logging.getLogger('beacon.hasher')
+
+# object types with a hash attribute
+HASH_TYPES = ('video', 'audio', 'image')
+
+# size of the blocks at the beginning and the end of the file used for
+# the partial hash
+HASH_BLOCK = 64 * 1024
+
+def partial_hash(filename):
+    """
+    Return the hash of a file based on the size and the first and last
+    block of the file. This is fast even for large files and good enough
+    to detect the same file at a different location.
+    """
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        size = os.fstat(f.fileno()).st_size
+        md5 = hashlib.md5(str(size))
+        md5.update(f.read(HASH_BLOCK))
+        if size > HASH_BLOCK:
+            f.seek(max(HASH_BLOCK, size - HASH_BLOCK))
+            md5.update(f.read(HASH_BLOCK))
+    finally:
+        f.close()
+    return '%x-%s' % (size, md5.hexdigest())
+
+
+def full_hash(filename):
+    """
+    Return the md5 hash of the complete file.
+    """
+    md5 = hashlib.md5()
+    f = open(filename, 'rb')
+    try:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            md5.update(data)
+    finally:
+        f.close()
+    return md5.hexdigest()
+
+
+# hashing thread
+kaa.register_thread_pool('beacon::hash', kaa.ThreadPool())
+hash_thread = kaa.ThreadPoolCallable('beacon::hash', partial_hash)
+full_hash_thread = kaa.ThreadPoolCallable('beacon::hash', full_hash)
+
+
+@kaa.coroutine()
+def find_moved(db, item, hash):
+    """
+    Find an object with the given hash on the same media whose file does
+    not exist anymore. This is the old entry of a file moved to item.
+    """
+    if not hash:
+        yield None
+    media = item._beacon_media._beacon_id[1]
+    for type in HASH_TYPES:
+        for row in db._db.query(type=type, hash=hash, media=media):
+            moved = yield db.query(id=(row['type'], row['id']))
+            if moved and moved.filename != item.filename and \
+                   not os.path.exists(moved.filename):
+                yield moved
+    yield None
+
+
+class Hasher(object):
+    """
+    Background hasher for all objects in the database without a hash.
+    """
+    def __init__(self, db):
+        self._db = db
+        self._coroutine = None
+
+
+    def start(self):
+        """
+        Start hashing if not already running.
+        """
+        if not self._coroutine or self._coroutine.finished:
+            self._coroutine = self._run()
+
+
+    def stop(self):
+        """
+        Stop hashing.
+        """
+        if self._coroutine and not self._coroutine.finished:
+            self._coroutine.abort()
+
+
+    @kaa.coroutine()
+    def _run(self):
+        """
+        Hash all files without a hash, throttled by the scheduler.
+        """
+        log.info('start hashing')
+        counter = 0
+        for type in HASH_TYPES:
+            ids = [ r['id'] for r in self._db._db.query(type=type, attrs=['id', 'hash'])
+                    if not r.get('hash') ]
+            for id in ids:
+                if not self._db._db.query(type=type, id=id, attrs=['id']):
+                    # deleted since the start
+                    continue
+                item = yield self._db.query(id=(type, id))
+                if not item or not getattr(item, 'filename', None) or \
+                       not os.path.isfile(item.filename):
+                    continue
+                hash = yield hash_thread(item.filename)
+                if not hash:
+                    continue
+                yield kaa.inprogress(self._db.read_lock)
+                self._db.update_object((type, id), hash=hash)
+                counter += 1
+                delay = scheduler.next(config.scheduler.policy) * config.scheduler.multiplier
+                if delay:
+                    yield kaa.delay(delay)
+        self._db.commit()
+        log.info('hashing done, %d files', counter)
@@ -32,6 +32,8 @@
 
 # python imports
 import logging
+import time
+from collections import deque
 
 # kaa imports
 import kaa
@@ -40,58 +42,123 @@ from kaa import OneShotTimer, Timer, NotFinished
 
 # kaa.beacon imports
 from ..item import Item
+from ..db import _facet_key
 from parser import parse
 import utils
 
 # get logging object
 log = logging.getLogger('beacon.monitor')
 
+# Maximum time in seconds the Master checks monitors in one step
+CHECK_BUDGET = 0.01
+
+# Number of items parsed in parallel in the initial scan
+PARSE_CHUNK = 10
+
+# Minimum time in seconds between progress notifications to the client
+NOTIFY_INTERVAL = 0.5
+
+def fingerprint(query):
+    """
+    Return a hashable key for the query dict. Identical queries from
+    different clients have the same key.
+    """
+    key = []
+    for attr, value in sorted(query.items()):
+        if isinstance(value, Item):
+            value = value._beacon_id
+        key.append((attr, _facet_key(value)))
+    return tuple(key)
+
+
 class Master(object):
     """
     Master Monitor. This monitor will connect to the db and will call all
-    monitors with the changes. This class will make sure they don't re-query
-    all at once and have a small delay between them to keep the load down.
+    monitors with the changes. Only monitors with changes are checked and
+    the time spent in one step is limited to keep the load down. Monitors
+    with priority are checked first. Monitors with the same query share
+    one evaluation of the query.
     """
     def __init__(self, db):
+        self._db = db
+        # list of [ monitor, priority, force, changes ]
         self.monitors = []
+        # query fingerprint -> InProgress of the query in the current check
+        self.results = {}
+        # monitors with changes not checked yet
+        self.priority = deque()
+        self.pending = deque()
         self.timer = Timer(self.check)
         db.signals['changed'].connect(self.changed)
 
 
-    def connect(self, monitor):
+    def connect(self, monitor, priority=False):
         """
         Connect a new monitor.
         """
-        self.monitors.append((weakref(monitor), [ False, [] ]))
+        self.monitors.append([ weakref(monitor), priority, False, [] ])
 
 
     def changed(self, changes):
         """
-        Database callback with changed ids.
+        Database callback with the ChangeSet of changed ids. The
+        ChangeSet is immutable, all monitors share the same object.
         """
-        if len(changes) == 1 and changes[0][0] == 'media':
-            for m, c in self.monitors:
-                c[0] = True
-        for m, c in self.monitors:
-            c[1].extend(changes)
+        # the results of all queries may be different now
+        self.results = {}
+        force = len(changes) == 1 and changes.types() == ['media']
+        for state in self.monitors:
+            if not state[3]:
+                # the monitor was clean, schedule it for the next check
+                if state[1]:
+                    self.priority.append(state)
+                else:
+                    self.pending.append(state)
+            if force:
+                state[2] = True
+            state[3].append(changes)
         if not self.timer.active:
             # TODO: should use scheduler to get interval
             self.timer.start(0.02)
 
 
+    def query(self, query):
+        """
+        Query the database. The result is shared with all monitors
+        using the same query in one check. Directory listings are not
+        shared, they also contain files not in the database. Returns an
+        InProgress object.
+        """
+        if 'parent' in query:
+            return self._db.query(**query)
+        key = fingerprint(query)
+        if not key in self.results:
+            self.results[key] = self._db.query(**query)
+        return self.results[key]
+
+
     def check(self):
         """
         Timed callback to call the connected monitor update functions.
         """
-        if not self.monitors:
-            return False
-        monitor, (force, changes) = self.monitors.pop(0)
-        if monitor == None:
-            return True
-        if changes or force:
-            monitor.check(changes)
-        self.monitors.append((monitor, [ False, [] ]))
-        return len(changes) > 0 or force
+        t0 = time.time()
+        while self.priority or self.pending:
+            if self.priority:
+                state = self.priority.popleft()
+            else:
+                state = self.pending.popleft()
+            monitor, force, changes = state[0], state[2], state[3]
+            state[2], state[3] = False, []
+            if monitor == None:
+                self.monitors.remove(state)
+                continue
+            monitor.check(changes, force)
+            if time.time() - t0 > CHECK_BUDGET:
+                break
+        # All monitors of this step started their query, do not keep
+        # the results.
+        self.results = {}
+        return bool(self.priority or self.pending)
 
 
 class Monitor(object):
@@ -101,7 +168,7 @@ class Monitor(object):
 
     _master = None
 
-    def __init__(self, client, db, server, id, query):
+    def __init__(self, client, db, server, id, query, priority=False):
         log.info('create new monitor %s' % id)
         self.id = id
         self._client = client
@@ -111,9 +178,10 @@ class Monitor(object):
         self._checking = False
         self._running = True
         self._check_changes = []
+        self._check_force = False
         if not Monitor._master:
             Monitor._master = Master(db)
-        Monitor._master.connect(self)
+        Monitor._master.connect(self, priority)
         self._initial_scan()
         if not 'parent' in query or query['parent']._beacon_id[0] != 'dir':
             # Generic search. We hope that everything needed ist
@@ -121,7 +189,7 @@ class Monitor(object):
             return
         dirname = query['parent'].filename
         crawler = query['parent']._beacon_media.crawler
-        if utils.statfs(dirname).f_type in ('nfs', 'smbfs'):
+        if utils.is_remote(dirname):
             # FIXME: how to get updates on directories not monitored by
             # inotify? Maybe poll the dirs when we have a query with
             # dirname it it?
@@ -143,10 +211,12 @@ class Monitor(object):
 
 
     @kaa.coroutine()
-    def check(self, changes):
+    def check(self, changes, force=False):
         """
         This function compares the last query result with the current db status
-        and will inform the client when there is a change.
+        and will inform the client when there is a change. The changes are a
+        list of ChangeSets since the last check. If force is True, the client
+        is informed even if no item changed (e.g. a media change).
         """
         if not self._running:
             yield True
@@ -158,14 +228,16 @@ class Monitor(object):
             # better to wait here. Note: with inotify support this should not
             # happen often.
             self._check_changes.extend(changes)
+            self._check_force = self._check_force or force
             yield True
 
         if self._check_changes:
             changes = self._check_changes + changes
             self._check_changes = []
+        force, self._check_force = force or self._check_force, False
 
         self._checking = True
-        current = yield self._db.query(**self._query)
+        current = yield Monitor._master.query(self._query)
         self._checking = False
 
         # The query result length is different, this is a change
@@ -181,7 +253,8 @@ class Monitor(object):
 
         # Same length, check for changes inside the items
         if isinstance(current[0], Item):
-            small_changes = False
+            # a media change affects the items without changing them
+            small_changes = force
             for i in current:
                 # We only compare the ids. If an item had no id before and
                 # has now we can't detect it. But we only call this function
@@ -192,8 +265,10 @@ class Monitor(object):
                     self.items = current
                     self.notify_client('changed', True)
                     yield True
-                if changes and i._beacon_id in changes:
-                    small_changes = True
+                for c in changes:
+                    if i._beacon_id in c:
+                        small_changes = True
+                        break
             if small_changes:
                 # only small stuff
                 log.info('monitor %s has changed (internal)', self.id)
@@ -229,12 +304,12 @@ class Monitor(object):
 
         changed = []
 
-        c = 0
+        timer = time.time()
         for i in self.items[:]:
-            c += 1
-            if c > 20:
+            if time.time() > timer + 0.05:
                 # stop it and continue in the next step
                 yield NotFinished
+                timer = time.time()
             # TODO: maybe also check parents?
             mtime = i._beacon_mtime
             if mtime != i._beacon_data.get('mtime'):
@@ -247,13 +322,24 @@ class Monitor(object):
             self._checking = False
             yield False
 
-        for pos, item in enumerate(changed):
-            self.notify_client('progress', pos+1, len(changed), item.url)
-            async = parse(self._db, item)
-            if isinstance(async, kaa.InProgress):
-                yield async
+        notified = time.time()
+        for pos in range(0, len(changed), PARSE_CHUNK):
+            # parse the next chunk of items in parallel
+            chunk = changed[pos:pos+PARSE_CHUNK]
+            parsing = [ parse(self._db, item) for item in chunk ]
+            parsing = [ async for async in parsing if isinstance(async, kaa.InProgress) ]
+            if parsing:
+                yield kaa.InProgressAll(*parsing)
             if not self._running:
                 break
+            if time.time() - notified > NOTIFY_INTERVAL and pos + PARSE_CHUNK < len(changed):
+                # Commit what we have so far and tell the client. The
+                # progress and changed notifications are rate limited to
+                # not flood the client with rpc calls.
+                notified = time.time()
+                self._db.commit()
+                self.notify_client('progress', pos+len(chunk), len(changed), chunk[-1].url)
+                self.notify_client('changed', True)
 
         # commit changes so that the client may get notified
         self._db.commit()
@@ -34,6 +34,7 @@
 
 # Python imports
 import os
+import stat
 import logging
 import time
 
@@ -44,6 +45,8 @@ import kaa.imlib2
 
 # kaa.beacon imports
 from .. import thumbnail
+from config import config
+import hasher
 import utils
 
 # get logging object
@@ -106,7 +109,16 @@ def parse(db, item, force_thumbnail_check=False):
         # list of items.
         db.sync_item(item)
 
-    if item._beacon_data.get('mtime') == mtime:
+    unchanged = item._beacon_data.get('mtime') == mtime
+    if unchanged and not item._beacon_isdir and item._beacon_data.get('size') is not None:
+        # Same mtime but a different size means the file was replaced.
+        # The stat result is from the directory listing, no extra
+        # system call is needed.
+        statinfo = item._beacon_stat
+        if statinfo and statinfo[stat.ST_SIZE] != item._beacon_data.get('size'):
+            unchanged = False
+
+    if unchanged:
         # The item already is in the database and the mtime is unchanged.
         # This means we don't need to scan again, but we check if the
         # thumbnail is valid or not.
@@ -123,10 +135,27 @@ def parse(db, item, force_thumbnail_check=False):
         else:
             return 0
 
+    if item._beacon_id and not item._beacon_isdir and utils.is_growing(item.filename):
+        # The file is still written. It will be parsed again when the
+        # size is stable, there is no need to parse it now.
+        log.debug('defer parsing of growing file %s', item)
+        return 0
+
     # looks like we have more to do. Start the coroutine part of the parser
     return _parse(db, item, mtime)
 
 
+def _stat_attributes(db, type, statinfo):
+    """
+    Return the inode, device, size and file_mtime attributes for the
+    stat result if the object type has them.
+    """
+    if not statinfo or not 'inode' in db._db._object_types[type][1]:
+        return {}
+    return { 'inode': statinfo[stat.ST_INO], 'device': statinfo[stat.ST_DEV],
+             'size': statinfo[stat.ST_SIZE], 'file_mtime': statinfo[stat.ST_MTIME] }
+
+
 @kaa.coroutine()
 def _parse(db, item, mtime):
     """
@@ -155,6 +184,94 @@ def _parse(db, item, mtime):
             yield r
 
 
+        #
+        # Move detection
+        #
+
+        hash = None
+        statinfo = None
+        if not item._beacon_isdir:
+            statinfo = item._beacon_stat
+        if config.hashing and not item._beacon_isdir:
+            hash = yield hasher.hash_thread(item.filename)
+
+        data = item._beacon_data
+        if item._beacon_id and statinfo and data.get('file_mtime') is not None and \
+               mtime - statinfo[stat.ST_MTIME] == data['mtime'] - data['file_mtime'] and \
+               (statinfo[stat.ST_DEV], statinfo[stat.ST_INO], statinfo[stat.ST_SIZE]) == \
+               (data.get('device'), data.get('inode'), data.get('size')) and \
+               (not hash or hash == data.get('hash')):
+            # Same file with the same size and the files belonging to it
+            # (e.g. cover images) did not change, only the mtime of the
+            # file itself changed (e.g. touch). No need to parse it again.
+            # With hashing enabled the content must be the same, too.
+            yield kaa.inprogress(db.read_lock)
+            db.update_object(item._beacon_id, mtime=mtime, file_mtime=statinfo[stat.ST_MTIME])
+            data['mtime'] = mtime
+            data['file_mtime'] = statinfo[stat.ST_MTIME]
+            yield produced_load
+
+        if not item._beacon_id and not item._beacon_isdir:
+            # A new file, maybe it was deleted somewhere else a short
+            # time ago. This happens when a file is moved from or to a
+            # directory not monitored by inotify.
+            tombstone = db.exhume(item._beacon_data['name'], mtime, hash, statinfo)
+            if tombstone and tombstone[1].get('scheme'):
+                # disc image with tracks, parse again to get the tracks
+                tombstone = None
+            if tombstone:
+                type, attributes, name = tombstone
+                log.info('%s was moved, reuse metadata', item)
+                dirname = os.path.dirname(item.filename)
+                for attr in ('image', 'poster'):
+                    image = attributes.get(attr)
+                    if not image or image.startswith('http://') or os.path.exists(image):
+                        continue
+                    if os.path.basename(image) == name:
+                        # the file is its own image
+                        moved = item.filename
+                    else:
+                        # cover image moved with the file
+                        moved = os.path.join(dirname, os.path.basename(image))
+                    if not os.path.exists(moved):
+                        del attributes[attr]
+                        continue
+                    thumbnail.Thumbnail(image, item._beacon_media)._move(moved)
+                    attributes[attr] = moved
+                if hash:
+                    attributes['hash'] = hash
+                attributes.update(_stat_attributes(db, type, statinfo))
+                yield kaa.inprogress(db.read_lock)
+                # check if for some reasons the same item was parsed
+                # parallel. If so, do not add it again.
+                entry = db._db.query(parent=parent._beacon_id, name=item._beacon_data['name'])
+                if entry:
+                    log.error('item already in db, re-use beacon_id')
+                    obj = entry[0]
+                else:
+                    obj = db.add_object(type, name=item._beacon_data['name'], parent=parent, **attributes)
+                item._beacon_database_update(obj)
+                yield produced_load
+
+            if hash:
+                # A new file, maybe an old entry was moved here.
+                moved = yield hasher.find_moved(db, item, hash)
+                if moved:
+                    # Reuse the old entry and its metadata
+                    log.info('%s moved to %s', moved, item)
+                    changes = { 'parent': parent._beacon_id, 'mtime': mtime,
+                                'name': item._beacon_data['name'] }
+                    changes.update(_stat_attributes(db, moved._beacon_id[0], statinfo))
+                    if moved._beacon_data.get('image') == moved.filename:
+                        # the file is its own image
+                        changes['image'] = item.filename
+                        thumbnail.Thumbnail(moved.filename, item._beacon_media)._move(item.filename)
+                    yield kaa.inprogress(db.read_lock)
+                    db.update_object(moved._beacon_id, **changes)
+                    item._beacon_database_update(db._db.query(
+                        type=moved._beacon_id[0], id=moved._beacon_id[1])[0])
+                    yield produced_load
+
         #
         # Metadata parsing
         #
@@ -186,6 +303,10 @@ def _parse(db, item, mtime):
         else:
             type = 'file'
 
+        if hash and type in hasher.HASH_TYPES:
+            attributes['hash'] = hash
+        attributes.update(_stat_attributes(db, type, statinfo))
+
         if item._beacon_id and type != item._beacon_id[0]:
             # The item changed its type. Adjust the db
             yield kaa.inprogress(db.read_lock)
@@ -352,9 +473,11 @@ def _parse(db, item, mtime):
 @kaa.coroutine()
 def add_directory_attributes(db, directory):
     """
-    Add some extra attributes for a directory recursive. This function
-    checkes album, artist, image and length. When there are changes,
-    go up to the parent and check it, too.
+    Add some extra attributes for a directory. This function checkes
+    album, artist, image and length based on the database entries of
+    the children. The filesystem is not listed. Returns True if the
+    directory was changed. The caller has to check the parent in that
+    case.
     """
     data = { 'length': 0, 'artist': u'', 'album': u'', 'image': '', 'series': '', 'season': '' }
     check_attr = data.keys()[:]
@@ -367,12 +490,12 @@ def add_directory_attributes(db, directory):
         del data['image']
 
     items = { 'video': [], 'audio': [], 'image': [], 'dir': [], 'other': [] }
-    for item in (yield db.query(parent=directory)):
-        t = item._beacon_data.get('type')
+    for row in db._db.query(parent=directory._beacon_id):
+        t = row['type']
         if t in items:
-            items[t].append(item)
+            items[t].append(row)
         else:
-            items['other'].append(item)
+            items['other'].append(row)
     relevant = []
     if (not items['video'] and not items['other'] and not items['dir']) and \
        ((len(items['audio']) > 2, len(items['image']) <= 1) or \
@@ -389,10 +512,10 @@ def add_directory_attributes(db, directory):
        items['dir'] and len(items['image']) <= 1:
         # only directories with maybe one folder/cover image
         relevant = items['dir']
-    for item in relevant:
-        data['length'] += item._beacon_data.get('length', 0) or 0
-        for attr in check_attr:
-            value = item._beacon_data.get(attr, data[attr])
+    for row in relevant:
+        data['length'] += row.get('length', 0) or 0
+        for attr in check_attr[:]:
+            value = row.get(attr, data[attr])
             if data[attr] == '':
                 data[attr] = value
             if data[attr] != value:
@@ -410,14 +533,11 @@ def add_directory_attributes(db, directory):
             break
     else:
         # no changes.
-        yield True
+        yield False
 
     yield kaa.inprogress(db.read_lock)
 
     # update directory in database
     db.update_object(directory._beacon_id, **data)
     directory._beacon_data.update(data)
-
-    # check parent
-    if directory._beacon_parent:
-        yield add_directory_attributes(db, directory._beacon_parent)
+    yield True
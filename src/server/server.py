@@ -42,10 +42,12 @@ import kaa.metadata
 
 # kaa.beacon server imports
 import parser
+import utils
 from controller import Controller
 from db import *
 from monitor import Monitor
 from crawl import Crawler
+from hasher import Hasher, full_hash_thread
 from config import config
 import plugins
 
@@ -96,13 +98,13 @@ class Server(object):
             poster = (str, kaa.beacon.ATTR_SIMPLE),
             width = (int, ATTR_SIMPLE),
             height = (int, ATTR_SIMPLE),
-            length = (float, ATTR_SIMPLE),
+            length = (float, ATTR_SEARCHABLE),
             scheme = (str, ATTR_SIMPLE),
             description = (unicode, ATTR_SIMPLE),
             series = (unicode, ATTR_SEARCHABLE),
             season = (int, ATTR_SEARCHABLE),
             episode = (int, ATTR_SEARCHABLE),
-            hash = (str, ATTR_SIMPLE),
+            hash = (str, ATTR_SEARCHABLE | ATTR_INDEXED),
             stereo = (str, ATTR_SIMPLE),
             timestamp = (int, ATTR_SEARCHABLE))
 
@@ -112,12 +114,12 @@ class Server(object):
             album = (unicode, ATTR_SEARCHABLE | ATTR_IGNORE_CASE | ATTR_INVERTED_INDEX, 'keywords'),
             genre = (unicode, ATTR_SEARCHABLE | ATTR_INDEXED | ATTR_IGNORE_CASE),
             samplerate = (int, ATTR_SIMPLE),
-            length = (float, ATTR_SIMPLE),
+            length = (float, ATTR_SEARCHABLE),
             bitrate = (int, ATTR_SIMPLE),
             trackno = (int, ATTR_SIMPLE),
             userdate = (unicode, ATTR_SIMPLE),
             description = (unicode, ATTR_SIMPLE),
-            hash = (str, ATTR_SIMPLE),
+            hash = (str, ATTR_SEARCHABLE | ATTR_INDEXED),
             timestamp = (int, ATTR_SEARCHABLE))
 
         self.register_file_type_attrs("image",
@@ -126,7 +128,7 @@ class Server(object):
             comment = (unicode, ATTR_SEARCHABLE | ATTR_IGNORE_CASE | ATTR_INVERTED_INDEX, 'keywords'),
             rotation = (int, ATTR_SIMPLE),
             author = (unicode, ATTR_SIMPLE),
-            hash = (str, ATTR_SIMPLE),
+            hash = (str, ATTR_SEARCHABLE | ATTR_INDEXED),
             timestamp = (int, ATTR_SEARCHABLE))
 
         # tracks for rom discs or iso files
@@ -174,12 +176,21 @@ class Server(object):
         # load plugins
         plugins.load(self, self._db)
 
+        # databases from older versions need the path attribute, all
+        # types are registered now.
+        self._db.update_paths()
+
         for dir in config.monitors:
             self.monitor_directory(os.path.expandvars(os.path.expanduser(dir)))
 
         # scanner
         self.scanner = Crawler(self._db, monitor=False)
 
+        # background hashing of files for move detection
+        self.hasher = Hasher(self._db)
+        if config.hashing:
+            self.hasher.start()
+
     # -------------------------------------------------------------
     # client handling
     # -------------------------------------------------------------
@@ -229,7 +240,7 @@ class Server(object):
             if not media.get('block.device'):
                 log.info('start crawler for /')
                 media.crawler = Crawler(self._db, use_inotify=True)
-        self._db.signals['changed'].emit([media._beacon_id])
+        self._db.signals['changed'].emit(ChangeSet([('update', media._beacon_id)]))
 
     def media_removed(self, media):
         """
@@ -237,7 +248,7 @@ class Server(object):
         """
         for id, client, monitors in self.clients:
             client.rpc('device.removed', media.id)
-        self._db.signals['changed'].emit([media._beacon_id])
+        self._db.signals['changed'].emit(ChangeSet([('update', media._beacon_id)]))
         if media.crawler:
             media.crawler.stop()
             media.crawler = None
@@ -271,12 +282,15 @@ class Server(object):
         type_name = 'track_%s' % type_name
         return self._db.register_object_type_attrs(type_name, indexes, **attrs)
 
-    @kaa.rpc.expose()
+    @kaa.rpc.expose(coroutine=True)
     def delete_media(self, id):
         """
-        Delete media with the given id.
+        Delete media with the given id. The clients are notified about
+        the progress.
         """
-        self._db.delete_media(id)
+        def progress(deleted, total):
+            self.notify_client('device.delete_progress', id, deleted, total)
+        yield self._db.delete_media(id, progress)
 
     @kaa.rpc.expose(add_client=True)
     def db_lock(self, client_id):
@@ -336,9 +350,10 @@ class Server(object):
         data._beacon_media.crawler.append(data)
 
     @kaa.rpc.expose(coroutine=True)
-    def monitor_add(self, client_id, request_id, query):
+    def monitor_add(self, client_id, request_id, query, priority=False):
         """
-        Create a monitor object to monitor a query for a client.
+        Create a monitor object to monitor a query for a client. Changes
+        of monitors with priority are checked first.
         """
         log.info('add monitor %s', query)
         if query and 'parent' in query:
@@ -351,7 +366,7 @@ class Server(object):
                 break
         else:
             raise AttributeError('Unknown client id %s', client_id)
-        m = Monitor(client, self._db, self, request_id, query)
+        m = Monitor(client, self._db, self, request_id, query, priority)
         monitors.append(m)
 
     @kaa.rpc.expose()
@@ -399,7 +414,7 @@ class Server(object):
             async = parser.parse(self._db, items.pop())
             if isinstance(async, kaa.InProgress):
                 yield async
-        yield data._beacon_data
+        yield dict(data._beacon_data.items())
 
     @kaa.rpc.expose(coroutine=True)
     def item_create(self, type, parent, **kwargs):
@@ -418,6 +433,20 @@ class Server(object):
         yield kaa.inprogress(self._db.read_lock)
         self._db.delete_object(id)
 
+    @kaa.rpc.expose(coroutine=True)
+    def item_hash(self, filename):
+        """
+        Return the md5 hash of the complete file.
+        """
+        yield full_hash_thread(filename)
+
+    @kaa.rpc.expose()
+    def growing_files(self):
+        """
+        Return all files still written with size and growth rate.
+        """
+        return utils.growing_files()
+
     @kaa.rpc.expose()
     def shutdown(self):
         """
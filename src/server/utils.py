@@ -29,26 +29,38 @@
 #
 # -----------------------------------------------------------------------------
 
-__all__ = [ 'BurstHandler', 'do_thumbnail' ]
+__all__ = [ 'BurstHandler', 'EventBuffer', 'do_thumbnail', 'is_growing',
+            'growing_files', 'fstype', 'is_remote' ]
 
 #python imports
 from collections import namedtuple
 import ctypes, ctypes.util
 import os
+import select
 import struct
+import time
+import logging
 
 # kaa imports
 import kaa
+from kaa.inotify import INotify
+
+# get logging object
+log = logging.getLogger('beacon.utils')
 
 class BurstHandler(object):
     """
-    Monitor growing files.
+    Monitor growing files. The size of each growing file is checked on
+    every poll and the callback is deferred until the size is stable.
+    Parsing a file while it is still written (e.g. a recording) is only
+    wasted time.
     """
 
     _all_instances = []
 
     def __init__(self, interval, callback):
-        self._ts = {}
+        # filename -> [ size, timestamp, rate, needed, start time ]
+        self._files = {}
         self._thumb = {}
         self._timer = kaa.WeakTimer(self._poll)
         self._timer.start(interval)
@@ -60,8 +72,8 @@ class BurstHandler(object):
         """
         Remove a file from the list of growing files.
         """
-        if name in self._ts:
-            del self._ts[name]
+        if name in self._files:
+            del self._files[name]
         if name in self._thumb:
             del self._thumb[name]
 
@@ -71,18 +83,35 @@ class BurstHandler(object):
         Return True if the file is growing. Detection is based on the
         frequency this function is called.
         """
-        if not name in self._ts:
-            self._ts[name] = False
+        if not name in self._files:
+            try:
+                size = os.stat(name).st_size
+            except OSError:
+                return False
+            now = time.time()
+            self._files[name] = [ size, now, 0.0, False, now ]
             return False
-        self._ts[name] = True
+        self._files[name][3] = True
         return True
 
 
+    def growing(self):
+        """
+        Return a dict of all growing files with the size, the estimated
+        growth rate in bytes per second and the time the file was first
+        seen growing.
+        """
+        result = {}
+        for name, (size, ts, rate, needed, started) in self._files.items():
+            result[name] = dict(size=size, rate=rate, started=started)
+        return result
+
+
     def _do_thumbnail(self, name):
         """
         Check if a thumbnail should be created.
         """
-        if not name in self._ts:
+        if not name in self._files:
             # not in the list of growing files
             return True
         if not name in self._thumb:
@@ -95,12 +124,100 @@ class BurstHandler(object):
 
     def _poll(self):
         """
-        Run callback on all growing files.
+        Check the size of all growing files and run the callback on all
+        files with a stable size.
+        """
+        now = time.time()
+        for name, info in self._files.items():
+            try:
+                size = os.stat(name).st_size
+            except OSError:
+                # file is gone, the inotify delete event handles it
+                self.remove(name)
+                continue
+            if size != info[0]:
+                # still growing, update the smoothed growth rate
+                rate = (size - info[0]) / max(now - info[1], 0.001)
+                info[2] = rate if not info[2] else (info[2] + rate) / 2
+                info[0], info[1] = size, now
+                continue
+            # The size did not change since the last poll. The writer is
+            # done or paused, parse the file if events were skipped.
+            self.remove(name)
+            if info[3]:
+                self._callback(name)
+
+
+class EventBuffer(object):
+    """
+    Collect INotify events for a short time and hand them over as one
+    batch. Events for the same filename are merged into one event while
+    the order of the first event of each filename is kept: a CREATE
+    absorbs following MODIFY events and a DELETE replaces
+    everything before it. Moves with a target are never merged and events
+    after a move start new entries, the order around a move matters.
+    """
+
+    def __init__(self, interval, callback, lock=None):
+        self._interval = interval
+        self._callback = callback
+        self._lock = lock
+        # list of [ mask, name, target ] in the order they arrived
+        self._events = []
+        # filename -> entry in self._events that can still be merged
+        self._index = {}
+        self._waiting = False
+        self._timer = kaa.WeakOneShotTimer(self.flush)
+
+
+    def add(self, mask, name, target=None):
+        """
+        Add an event to the buffer.
         """
-        ts = self._ts
-        self._ts = {}
-        for name in [ name for name, needed in ts.items() if needed ]:
-            self._callback(name)
+        if target:
+            # move barrier
+            self._events.append([ mask, name, target ])
+            self._index = {}
+        else:
+            event = self._index.get(name)
+            if event is None:
+                event = self._index[name] = [ mask, name, None ]
+                self._events.append(event)
+            elif mask & (INotify.DELETE | INotify.DELETE_SELF) or \
+                     event[0] & (INotify.DELETE | INotify.DELETE_SELF):
+                # deleted or deleted and created again
+                event[0] = mask
+            else:
+                event[0] |= mask
+            if event[0] & INotify.CREATE:
+                event[0] &= ~INotify.MODIFY
+        if not self._timer.active and not self._waiting:
+            self._timer.start(self._interval)
+
+
+    def flush(self):
+        """
+        Hand all buffered events to the callback. If the lock is held,
+        wait until it is released.
+        """
+        if self._lock is not None and self._lock.locked:
+            if not self._waiting:
+                self._waiting = True
+                kaa.inprogress(self._lock).connect_once(self._unlocked)
+            return
+        events = [ tuple(e) for e in self._events ]
+        self._events = []
+        self._index = {}
+        if events:
+            self._callback(events)
+
+
+    def _unlocked(self, *args):
+        """
+        Callback when the lock is released.
+        """
+        self._waiting = False
+        self.flush()
 
 
 def do_thumbnail(name):
@@ -113,6 +230,82 @@ def do_thumbnail(name):
     return False
 
 
+def is_growing(name):
+    """
+    Global function to check if a file is growing. The callback of the
+    burst handler will run for the file when the size is stable.
+    """
+    for i in BurstHandler._all_instances:
+        info = i._files.get(name)
+        if info and info[3]:
+            return True
+    return False
+
+
+def growing_files():
+    """
+    Global function to get the growing files of all burst handlers.
+    """
+    result = {}
+    for i in BurstHandler._all_instances:
+        result.update(i.growing())
+    return result
+
+
+# filesystem magic numbers from statfs(2)
+FSTYPES = {
+    0xadf5: 'adfs',
+    0xadff: 'affs',
+    0x5346414F: 'afs',
+    0x0187: 'autofs',
+    0x73757245: 'coda',
+    0x28cd3d45: 'cramfs',
+    0x453dcd28: 'cramfs',
+    0x64626720: 'debugfs',
+    0x62656572: 'sysfs',
+    0x73636673: 'securityfs',
+    0x858458f6: 'ramfs',
+    0x01021994: 'tmpfs',
+    0x958458f6: 'hugetblfs',
+    0x73717368: 'squashfs',
+    0x414A53: 'efs',
+    0xEF53: 'ext2/ext3',
+    0xabba1974: 'xenfs',
+    0x9123683E: 'btrfs',
+    0xf995e849: 'hpfs',
+    0x9660: 'isofs',
+    0x4004: 'isofs',
+    0x4000: 'isofs',
+    0x07C0: 'jffs',
+    0x72b6: 'jffs2',
+    0x4d44: 'msdos',
+    0x58465342: 'xfs',
+    0x6969: 'nfs',
+    0x6E667364: 'nfsd',
+    0x15013346: 'udf',
+    0x00011954: 'ufs',
+    0x54190100: 'ufs',
+    0x9FA2: 'usbdevfs',
+    0x9fa0: 'procfs',
+    0x002f: 'qnx4',
+    0x52654973: 'reiserfs',
+    0x517B: 'smbfs',
+    0xFF534D42: 'cifs',
+    0xFE534D42: 'smb2',
+    0x9fa2: 'usbfs',
+    0xBAD1DEA: 'futexfs',
+    0x2BAD1DEA: 'inotifyfs',
+    0x1cd1: 'devpts',
+    0x534F434B: 'sockfs',
+    0xabababab: 'vmblock',
+    0x65735543: 'fusectl',
+    0x42494e4d: 'binfmt_misc',
+}
+
+# network filesystems, changes from other hosts are invisible to inotify
+REMOTE_FSTYPES = ('nfs', 'nfs4', 'smbfs', 'cifs', 'smb2', 'smb3')
+
+
 statfs_result = namedtuple('statfs_result', 'f_type, f_bsize, f_blocks, f_bfree, f_bavail,'
                                             'f_files, f_ffree, f_fsid, f_namelen, f_frsize')
 def statfs(path):
@@ -142,50 +335,85 @@ def statfs(path):
         raise OSError(errno, "%s: '%s'" % (os.strerror(errno), path))
 
     result = struct.unpack(fmt, buf)[:10]
-    fstypes = { 
-        0xadf5: 'adfs',
-        0xadff: 'affs',
-        0x5346414F: 'afs',
-        0x0187: 'autofs',
-        0x73757245: 'coda',
-        0x28cd3d45: 'cramfs',
-        0x453dcd28: 'cramfs',
-        0x64626720: 'debugfs',
-        0x62656572: 'sysfs',
-        0x73636673: 'securityfs',
-        0x858458f6: 'ramfs',
-        0x01021994: 'tmpfs',
-        0x958458f6: 'hugetblfs',
-        0x73717368: 'squashfs',
-        0x414A53: 'efs',
-        0xEF53: 'ext2/ext3',
-        0xabba1974: 'xenfs',
-        0x9123683E: 'btrfs',
-        0xf995e849: 'hpfs',
-        0x9660: 'isofs',
-        0x4004: 'isofs',
-        0x4000: 'isofs',
-        0x07C0: 'jffs',
-        0x72b6: 'jffs2',
-        0x4d44: 'msdos',
-        0x58465342: 'xfs',
-        0x6969: 'nfs',
-        0x6E667364: 'nfsd',
-        0x15013346: 'udf',
-        0x00011954: 'ufs',
-        0x54190100: 'ufs',
-        0x9FA2: 'usbdevfs',
-        0x9fa0: 'procfs',
-        0x002f: 'qnx4',
-        0x52654973: 'reiserfs',
-        0x517B: 'smbfs',
-        0x9fa2: 'usbfs',
-        0xBAD1DEA: 'futexfs',
-        0x2BAD1DEA: 'inotifyfs',
-        0x1cd1: 'devpts',
-        0x534F434B: 'sockfs',
-        0xabababab: 'vmblock',
-        0x65735543: 'fusectl',
-        0x42494e4d: 'binfmt_misc',
-    }
-    return statfs_result(fstypes.get(result[0], result[0]), *result[1:])
+    return statfs_result(FSTYPES.get(result[0], result[0]), *result[1:])
+
+
+class MountTable(object):
+    """
+    Filesystem types of all mount points read from /proc/self/mountinfo.
+    The file is read again when the kernel reports a mount change by
+    poll(2), so looking up the type of a path is a dictionary lookup
+    for each parent directory.
+    """
+
+    MOUNTINFO = '/proc/self/mountinfo'
+
+    def __init__(self):
+        self._mounts = {}
+        self._poll = None
+        self._checked = 0
+        try:
+            self._fd = open(self.MOUNTINFO)
+        except IOError:
+            # not Linux, use statfs
+            self._fd = None
+            return
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLPRI | select.POLLERR)
+        self.refresh()
+
+
+    def refresh(self):
+        """
+        Read the mount table.
+        """
+        mounts = {}
+        self._fd.seek(0)
+        for line in self._fd.read().splitlines():
+            fields, fs = line.split(' - ', 1)
+            # mount point with octal escapes for space, tab, newline and backslash
+            mountpoint = fields.split()[4].decode('string_escape')
+            # later mounts hide earlier ones on the same mount point
+            mounts[mountpoint] = fs.split()[0]
+        self._mounts = mounts
+        log.info('read %d mount points', len(mounts))
+
+
+    def fstype(self, path):
+        """
+        Return the filesystem type of the given path.
+        """
+        if self._fd is None:
+            return statfs(path).f_type
+        now = time.time()
+        if now - self._checked > 1:
+            # check for mount changes at most once per second
+            self._checked = now
+            if self._poll.poll(0):
+                self.refresh()
+        # statfs follows symlinks, the mount table must be searched with
+        # the real path
+        path = os.path.realpath(path)
+        while True:
+            fstype = self._mounts.get(path)
+            if fstype is not None:
+                return fstype
+            if path == '/':
+                return statfs(path).f_type
+            path = os.path.dirname(path)
+
+
+def fstype(path):
+    """
+    Global function to get the filesystem type of the given path.
+    """
+    if not hasattr(fstype, 'mounts'):
+        fstype.mounts = MountTable()
+    return fstype.mounts.fstype(path)
+
+
+def is_remote(path):
+    """
+    Return True if the path is on a network filesystem.
+    """
+    return fstype(path) in REMOTE_FSTYPES
@@ -170,6 +170,21 @@ class Thumbnail(object):
         libthumb.png(self.name, i, SIZE[type], image._image)
         log.info('store %s', i)
 
+    def _move(self, name):
+        """
+        Move the thumbnails to the new filename of the image. DO NOT USE
+        OUTSIDE OF BEACON
+        """
+        dest = self.destdir + '/%s/' + hashlib.md5('file://' + name).hexdigest() + '.png'
+        for type in (NORMAL, LARGE, 'fail/beacon'):
+            if os.path.isfile(self._thumbnail % type):
+                try:
+                    os.rename(self._thumbnail % type, dest % type)
+                except OSError:
+                    log.exception('move thumbnail')
+        self.name = name
+        self._thumbnail = dest
+
     @property
     def needs_update(self):
         """